@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import psycopg2.extras
+
 
 class Account(object):
     def __init__(
@@ -131,6 +133,7 @@ class Account(object):
             )
             self.db.messages.flush(curs)
             curs.connection.commit()
+        self.db.forget_portfolios()
         return self
 
     @property
@@ -151,9 +154,45 @@ class Account(object):
         # and db will be None.  FIXME: this should be clearer.
         if not self.db:
             return self._balance
+        return self.portfolio["balance"]
+
+    @property
+    def portfolio(self):
+        """
+        A summary of what the account holds, in millitokens: its free balance,
+        the collateral locked up in its FIXED and UNFIXED offers, and the
+        basis and number of its positions.  One query, then cached if this
+        thread is handling a request (see Market.portfolios).
+        """
+        cache = self.db.portfolios
+        if cache is not None and self.id in cache:
+            return cache[self.id]
         with self.db.conn.cursor() as curs:
-            curs.execute("SELECT balance FROM account WHERE id = %s", (self.id,))
-            return curs.fetchone()[0]
+            curs.execute(
+                """SELECT account.balance, offers.fixed, offers.unfixed,
+                            positions.basis, positions.count
+                            FROM account,
+                            LATERAL (SELECT
+                                COALESCE(SUM(price * quantity) FILTER (WHERE side), 0) AS fixed,
+                                COALESCE(SUM((1000 - price) * quantity) FILTER (WHERE NOT side), 0)
+                                AS unfixed
+                                FROM offer WHERE offer.account = account.id) AS offers,
+                            LATERAL (SELECT COALESCE(SUM(basis), 0) AS basis, COUNT(*) AS count
+                                FROM position WHERE position.account = account.id) AS positions
+                            WHERE account.id = %s""",
+                (self.id,),
+            )
+            (balance, fixed, unfixed, basis, positions) = curs.fetchone()
+        summary = {
+            "balance": balance,
+            "fixed_collateral": int(fixed),
+            "unfixed_collateral": int(unfixed),
+            "basis": int(basis),
+            "positions": positions,
+        }
+        if cache is not None:
+            cache[self.id] = summary
+        return summary
 
     def add_balance(self, bonus):
         "Add an amount in millitokens"
@@ -161,25 +200,32 @@ class Account(object):
 
     @property
     def total(self):
-        total = 0
-        with self.db.conn.cursor() as curs:
-            curs.execute("SELECT balance FROM account WHERE id = %s", (self.id,))
-            total = curs.fetchone()[0]
-            curs.execute(
-                "SELECT price, quantity FROM offer WHERE account = %s AND side = %s",
-                (self.id, self.db.FIXED),
-            )
-            for row in curs.fetchall():
-                (p, q) = row
-                total += p * q
-            curs.execute(
-                "SELECT price, quantity FROM offer WHERE account = %s AND side = %s",
-                (self.id, self.db.UNFIXED),
-            )
-            for row in curs.fetchall():
-                (p, q) = row
-                total += (1000 - p) * q
-        return total
+        "Balance plus the collateral in offers, in millitokens."
+        summary = self.portfolio
+        return (
+            summary["balance"]
+            + summary["fixed_collateral"]
+            + summary["unfixed_collateral"]
+        )
+
+    @staticmethod
+    def add_balances(curs, amounts):
+        """
+        Add amounts in millitokens to several accounts in one statement.
+        amounts is a mapping of account id to amount.
+        """
+        rows = sorted((uid, amount) for (uid, amount) in amounts.items() if amount)
+        if not rows:
+            return
+        psycopg2.extras.execute_values(
+            curs,
+            """UPDATE account SET balance = account.balance + amounts.amount
+            FROM (VALUES %s) AS amounts (id, amount) WHERE account.id = amounts.id""",
+            rows,
+            page_size=len(rows),
+        )
+        if curs.rowcount != len(rows):
+            raise RuntimeError
 
     @classmethod
     def get_by_oauth(cls, curs, host, sub, db=None):
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Call auctions. A contract type in auction mode does not match offers as
+# they come in. Offers wait on the book, and a clearing pass matches as many
+# of them as it can at one price, the clearing price, which every contract
+# formed in that pass gets. See ContractType.clear.
+
+
+def allocate(offers, volume):
+    """
+    Fill offers in order, best first, up to volume units.  All or nothing
+    offers that don't fit in what is left are skipped.  Returns a list of
+    (entry, quantity) fills and the number of units filled.
+    """
+    fills = []
+    left = volume
+    for entry in offers:
+        if left == 0:
+            break
+        if entry.all_or_nothing and entry.quantity > left:
+            continue
+        quantity = min(entry.quantity, left)
+        fills.append((entry, quantity))
+        left -= quantity
+    return (fills, volume - left)
+
+
+def match_at(fixed, unfixed, price):
+    """
+    Match as many units as possible at one price.  fixed and unfixed are the
+    offers on each side, best first.  Returns the fills on each side, which
+    always add up to the same number of units.
+    """
+    fixed = [entry for entry in fixed if entry.price >= price]
+    unfixed = [entry for entry in unfixed if entry.price <= price]
+    volume = min(
+        sum(entry.quantity for entry in fixed),
+        sum(entry.quantity for entry in unfixed),
+    )
+    # Skipping an all or nothing offer on one side can leave less to fill on
+    # the other, so shrink the volume until the two sides agree.
+    while True:
+        (fixed_fills, fixed_volume) = allocate(fixed, volume)
+        (unfixed_fills, unfixed_volume) = allocate(unfixed, volume)
+        if fixed_volume == unfixed_volume:
+            return (fixed_fills, unfixed_fills)
+        volume = min(fixed_volume, unfixed_volume)
+
+
+def clearing(offers):
+    """
+    Find the clearing price for a batch of offers: the price that matches the
+    most units.  Ties go to the price that leaves the least unmatched
+    interest, then to the middle of the prices that are still tied.
+
+    Returns the price, with None if nothing matches, and the fills on the
+    FIXED and UNFIXED sides.
+    """
+    fixed = sorted(
+        (entry for entry in offers if entry.side),
+        key=lambda entry: (-entry.price, entry.created, entry.id),
+    )
+    unfixed = sorted(
+        (entry for entry in offers if not entry.side),
+        key=lambda entry: (entry.price, entry.created, entry.id),
+    )
+    candidates = []
+    for price in sorted(set(entry.price for entry in offers)):
+        (fixed_fills, unfixed_fills) = match_at(fixed, unfixed, price)
+        volume = sum(quantity for (entry, quantity) in fixed_fills)
+        if not volume:
+            continue
+        surplus = abs(
+            sum(entry.quantity for entry in fixed if entry.price >= price)
+            - sum(entry.quantity for entry in unfixed if entry.price <= price)
+        )
+        candidates.append((-volume, surplus, price, fixed_fills, unfixed_fills))
+    if not candidates:
+        return (None, [], [])
+    best = min(candidates)[:2]
+    candidates = [c for c in candidates if c[:2] == best]
+    (volume, surplus, price, fixed_fills, unfixed_fills) = candidates[
+        (len(candidates) - 1) // 2
+    ]
+    return (price, fixed_fills, unfixed_fills)
+
+
+def pair(fixed_fills, unfixed_fills):
+    """
+    Pair up the fills on the two sides, best first, into (fixed entry,
+    unfixed entry, quantity) contracts.
+    """
+    result = []
+    fixed_fills = [[entry, quantity] for (entry, quantity) in fixed_fills]
+    unfixed_fills = [[entry, quantity] for (entry, quantity) in unfixed_fills]
+    (i, j) = (0, 0)
+    while i < len(fixed_fills) and j < len(unfixed_fills):
+        quantity = min(fixed_fills[i][1], unfixed_fills[j][1])
+        result.append((fixed_fills[i][0], unfixed_fills[j][0], quantity))
+        fixed_fills[i][1] -= quantity
+        unfixed_fills[j][1] -= quantity
+        if not fixed_fills[i][1]:
+            i += 1
+        if not unfixed_fills[j][1]:
+            j += 1
+    return result
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Benchmark the market with synthetic order flow, from bots modeled on the
+# trader types in doc/TRADERS.md, against a local database:
+#
+#   DB_NAME=scratch bench.py --issues=2000 --orders=20000 > results.json
+#
+# Each run makes its own issues and accounts, so it can be repeated on the
+# same database. The results are JSON, to compare between commits.
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import uuid
+
+from account import Account
+from issue import Issue
+from maturity import Maturity
+from timing import Timings
+
+
+class Bot(object):
+    "A trader that places offers in some style, on contract types chosen at random."
+
+    balance = 10**12
+    weight = 1  # how often this kind of bot trades, relative to the others
+
+    def __init__(self, db, rng):
+        self.db = db
+        self.rng = rng
+        self.account = Account(balance=self.balance).persist(db)
+
+    def offers(self, ctypes):
+        "The offers for one turn, as (contract type, side, price, quantity, all or nothing)."
+        raise NotImplementedError
+
+
+class KillerWhale(Bot):
+    "Buys FIXED in size, all or nothing, at a high price."
+
+    weight = 1
+
+    def offers(self, ctypes):
+        ctype = self.rng.choice(ctypes)
+        return [
+            (ctype, True, self.rng.randint(450, 600), self.rng.randint(200, 2000), True)
+        ]
+
+
+class Frontrunner(Bot):
+    "Buys FIXED ahead of a developer, then offers to cover at a profit."
+
+    weight = 3
+
+    def __init__(self, db, rng):
+        super().__init__(db, rng)
+        self.holding = []
+
+    def offers(self, ctypes):
+        if self.holding and self.rng.random() < 0.5:
+            (ctype, price, quantity) = self.holding.pop(0)
+            return [
+                (
+                    ctype,
+                    False,
+                    min(999, price + self.rng.randint(20, 100)),
+                    quantity,
+                    False,
+                )
+            ]
+        ctype = self.rng.choice(ctypes)
+        (price, quantity) = (self.rng.randint(200, 700), self.rng.randint(10, 100))
+        self.holding.append((ctype, price, quantity))
+        return [(ctype, True, price, quantity, False)]
+
+
+class Fan(Bot):
+    "Places several small UNFIXED offers on a favorite issue, latest maturity."
+
+    weight = 6
+
+    def offers(self, ctypes):
+        issue = self.rng.choice(ctypes).issue.id
+        ctype = max(
+            (c for c in ctypes if c.issue.id == issue),
+            key=lambda c: c.maturity.maturity,
+        )
+        return [
+            (ctype, False, self.rng.randint(100, 500), self.rng.randint(1, 10), False)
+            for i in range(self.rng.randint(2, 5))
+        ]
+
+
+def setup(db, issues, maturities=3):
+    "Make issues for this run, and a contract type for each one at each maturity."
+    run = uuid.uuid4()
+    when = db.now()
+    mats = []
+    for i in range(maturities):
+        when = Maturity.next_expiration_after(when)
+        mats.append(Maturity(when).persist(db))
+    ctypes = []
+    for i in range(issues):
+        issue = Issue(url="https://bench.example.com/%s/%d" % (run, i)).persist(db)
+        for maturity in mats:
+            ctypes.append(db.contract_type(issue, maturity).persist())
+    return ctypes
+
+
+def run(db, issues=100, orders=1000, bots=20, resolve=10, seed=0):
+    """
+    Place orders from a mix of bots, and time placing offers, looking them
+    up, listing issues and resolving contract types.  Returns the timings.
+    """
+    rng = random.Random(seed)
+    timings = Timings()
+    ctypes = setup(db, issues)
+    kinds = [KillerWhale, Frontrunner, Fan]
+    population = [
+        rng.choices(kinds, weights=[k.weight for k in kinds])[0](db, rng)
+        for i in range(bots)
+    ]
+    (placed, turns) = (0, 0)
+    while placed < orders:
+        bot = rng.choice(population)
+        for (ctype, side, price, quantity, aon) in bot.offers(ctypes):
+            offer = db.offer(
+                bot.account, ctype, side, price, quantity, all_or_nothing=aon
+            )
+            with timings.time("Offer.place"):
+                offer.place()
+            placed += 1
+        turns += 1
+        # Reads, at roughly the rate that people look at the site.
+        if turns % 10 == 0:
+            with timings.time("Offer.filter"):
+                db.offer.filter(issue=rng.choice(ctypes).issue)
+        if turns % 100 == 0:
+            with timings.time("Issue.get_all"):
+                list(Issue.get_all(db))
+    for ctype in rng.sample(ctypes, min(resolve, len(ctypes))):
+        with timings.time("ContractType.resolve"):
+            ctype.resolve(rng.random() < 0.5)
+    return timings
+
+
+def revision():
+    "The git commit being measured, if there is one."
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    from market import Market
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--issues", type=int, default=1000)
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--bots", type=int, default=50)
+    parser.add_argument("--resolve", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    market = Market()
+    timings = run(market, args.issues, args.orders, args.bots, args.resolve, args.seed)
+    json.dump(
+        {
+            "revision": revision(),
+            "config": vars(args),
+            "timings": timings.summary(),
+        },
+        sys.stdout,
+        indent=2,
+    )
+    print()
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+# The order book for a contract type, kept in memory so that matching a new
+# offer does not have to read the whole opposite side of the book from the
+# database every time.
+#
+# The offer table is still the record of what is on the book. Matching writes
+# every change through to the offer table in the same transaction, and a
+# trigger counts changes to the offers on each contract type in
+# contract_type.book_version (see schema.sql). A book in memory is only used
+# if its version matches the database, so a change made by another process
+# (or a transaction that failed part way through) just means a reload.
+#
+# Books are loaded lazily, a page at a time and best price first, so that a
+# small offer against a deep book only reads the few offers that it needs.
+
+import bisect
+import collections
+import threading
+
+
+class BookEntry(object):
+    "One resting offer on the book."
+
+    def __init__(
+        self,
+        oid,
+        account,
+        side,
+        price,
+        quantity,
+        all_or_nothing=False,
+        created=None,
+        expires=None,
+    ):
+        self.id = oid
+        self.account = account
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        self.all_or_nothing = all_or_nothing
+        self.created = created
+        self.expires = expires
+
+    def __repr__(self):
+        return "offer %s: %d units on side %s at %d" % (
+            self.id,
+            self.quantity,
+            self.side,
+            self.price,
+        )
+
+    def expired(self, now):
+        return self.expires is not None and now is not None and self.expires <= now
+
+
+class OrderBook(object):
+    """
+    Resting offers for one contract type, in price levels. Each side keeps a
+    sorted list of the prices that have offers, and a FIFO queue of offers at
+    each price, so that the best offers are found without a scan.
+
+    Only the best part of each side is in memory.  Offers on a side are
+    ranked best first by price, then by age, then by id, and for each side
+    the book keeps the frontier: the rank of the last offer loaded, and the
+    worst price at which every offer is known to be loaded.  Every offer
+    that ranks no worse than the frontier is in memory, and no other.
+    """
+
+    page_size = 100
+
+    def __init__(self, cid):
+        self.cid = cid
+        self.version = None
+        self.auction = False  # offers wait for a call auction instead of matching
+        self.now = None  # database time when the book was last locked
+        self.levels = {True: {}, False: {}}  # side: {price: deque of entries}
+        self.prices = {True: [], False: []}  # side: sorted prices with offers
+        self.entries = {}  # offer id: entry
+        self.last = {True: None, False: None}  # side: rank of the last offer loaded
+        self.through = {True: None, False: None}  # side: price rank loaded in full
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def price_rank(side, price):
+        "Rank prices so that the best price on each side is lowest."
+        if side:  # FIXED offers are better the more they offer
+            return -price
+        return price
+
+    def rank(self, entry):
+        return (self.price_rank(entry.side, entry.price), entry.created, entry.id)
+
+    def loaded(self, entry):
+        "Whether an offer on the book is one that belongs in memory."
+        rank = self.rank(entry)
+        through = self.through[entry.side]
+        if through is not None and rank[0] <= through:
+            return True
+        last = self.last[entry.side]
+        return last is not None and rank <= last
+
+    def fetch(self, curs, side, price):
+        """
+        Load the next page of offers on one side of the book, going no further
+        than the given price.  Return the offers loaded, and whether there may
+        be more of them before that price.
+        """
+        (last, through) = (self.last[side], self.through[side])
+        if through is not None and through >= self.price_rank(side, price):
+            return ([], False)
+        if side:  # FIXED, best price is highest
+            (order, worse, within) = ("price DESC, created, id", "<", ">=")
+        else:  # UNFIXED, best price is lowest
+            (order, worse, within) = ("price, created, id", ">", "<=")
+        where = "contract_type = %%s AND side = %%s AND price %s %%s" % within
+        args = [self.cid, side, price]
+        if through is not None and (last is None or through >= last[0]):
+            where += " AND price %s %%s" % worse
+            args.append(abs(through))
+        elif last is not None:
+            where += (
+                " AND (price %s %%s OR (price = %%s AND (created, id) > (%%s, %%s)))"
+                % (worse)
+            )
+            args.extend((abs(last[0]), abs(last[0]), last[1], last[2]))
+        curs.execute(
+            """SELECT id, account, side, price, quantity, all_or_nothing, created, expires
+                        FROM offer WHERE %s ORDER BY %s LIMIT %%s"""
+            % (where, order),
+            args + [self.page_size],
+        )
+        entries = [self.insert(BookEntry(*row)) for row in curs.fetchall()]
+        if entries:
+            self.last[side] = self.rank(entries[-1])
+        if len(entries) < self.page_size:
+            rank = self.price_rank(side, price)
+            if through is None or rank > through:
+                self.through[side] = rank
+            return (entries, False)
+        return (entries, True)
+
+    def insert(self, entry):
+        levels = self.levels[entry.side]
+        level = levels.get(entry.price)
+        if level is None:
+            level = levels[entry.price] = collections.deque()
+            bisect.insort(self.prices[entry.side], entry.price)
+        level.append(entry)
+        self.entries[entry.id] = entry
+        return entry
+
+    def add(self, entry):
+        """
+        Put a new offer on the book.  It is only kept in memory if it falls
+        within the part of the book that has been loaded; otherwise it will
+        be loaded with the rest when it is needed.
+        """
+        if self.loaded(entry):
+            self.insert(entry)
+        return entry
+
+    def remove(self, oid):
+        entry = self.entries.pop(oid, None)
+        if entry is None:
+            return None
+        levels = self.levels[entry.side]
+        level = levels[entry.price]
+        level.remove(entry)
+        if not level:
+            del levels[entry.price]
+            prices = self.prices[entry.side]
+            del prices[bisect.bisect_left(prices, entry.price)]
+        return entry
+
+    def reduce(self, oid, quantity):
+        "Take quantity units off a resting offer, removing it if none are left."
+        entry = self.entries[oid]
+        if quantity >= entry.quantity:
+            return self.remove(oid)
+        entry.quantity -= quantity
+        return entry
+
+    def crossing(self, curs, side, price):
+        """
+        Resting offers that a new offer on the given side and price could match,
+        best price first and oldest first at each price.  A FIXED offer matches
+        UNFIXED offers at or below its price, an UNFIXED offer matches FIXED
+        offers at or above its price.  Offers are loaded from the database as
+        the caller gets to them, so stop iterating as soon as possible.
+        """
+        resting = not side
+        prices = self.prices[resting]
+        levels = self.levels[resting]
+        if resting:  # FIXED
+            order = reversed(prices[bisect.bisect_left(prices, price) :])
+        else:  # UNFIXED
+            order = prices[: bisect.bisect_right(prices, price)]
+        for p in list(order):
+            for entry in list(levels.get(p, ())):
+                if entry.id in self.entries:
+                    yield entry
+        more = True
+        while more:
+            (entries, more) = self.fetch(curs, resting, price)
+            for entry in entries:
+                if entry.id in self.entries:
+                    yield entry
+
+
+class BookCache(object):
+    """
+    The order books this process has used, by contract type id.  Books are
+    loaded the first time they are needed and kept until the database shows
+    that they have changed.
+
+    Threads share the books, but a thread only uses a book while its
+    transaction holds the lock on the contract_type row, so two threads
+    never change the same book at once.
+
+    Committing or rolling back also drops the market's cached portfolio
+    summaries for this thread, since the transaction may have changed them.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self.books = {}
+        self.local = threading.local()
+
+    @property
+    def touched(self):
+        "Books locked by this thread's transaction, by contract type id."
+        touched = getattr(self.local, "touched", None)
+        if touched is None:
+            touched = self.local.touched = {}
+        return touched
+
+    def get(self, curs, cid):
+        """
+        Lock the contract type for the rest of the transaction and return its
+        order book.  The book starts again empty, to be loaded as it is used,
+        if it is not known to match the database.
+        """
+        if cid in self.touched:  # already locked in this transaction
+            return self.touched[cid]
+        curs.execute(
+            """SELECT book_version, auction, LOCALTIMESTAMP FROM contract_type
+                        WHERE id = %s FOR UPDATE""",
+            (cid,),
+        )
+        if curs.rowcount != 1:
+            # No such contract type. Any offer on it will fail to persist.
+            return OrderBook(cid)
+        (version, auction, now) = curs.fetchone()
+        book = self.books.get(cid)
+        if book is None or book.version is None or book.version != version:
+            book = self.books[cid] = OrderBook(cid)
+        book.auction = auction
+        book.now = now
+        # The book is changed ahead of the database from here on, so don't trust
+        # it again until the transaction commits.
+        book.version = None
+        self.touched[cid] = book
+        return book
+
+    def commit(self, curs):
+        "Commit the transaction, and trust the books that it changed again."
+        versions = {}
+        if self.touched:
+            curs.execute(
+                "SELECT id, book_version FROM contract_type WHERE id = ANY(%s)",
+                (list(self.touched),),
+            )
+            versions = dict(curs.fetchall())
+        curs.connection.commit()
+        for (cid, book) in self.touched.items():
+            book.version = versions.get(cid)
+        self.local.touched = {}
+        if self.db is not None:
+            self.db.forget_portfolios()
+
+    def abort(self, curs):
+        """
+        Roll back a transaction that failed, releasing its locks, and forget
+        the books that it changed.
+        """
+        for cid in self.touched:
+            self.books.pop(cid, None)
+        self.local.touched = {}
+        curs.connection.rollback()
+        if self.db is not None:
+            self.db.forget_portfolios()
+
+
+def depth(curs, iid):
+    """
+    The depth of the book for every contract type on an issue, from the
+    price levels in book_level.  Returns a list, soonest maturity first, of
+    dicts with the contract type and maturity and each side's levels, best
+    price first.  A level is (price, quantity, orders, all or nothing
+    quantity).
+    """
+    curs.execute(
+        """SELECT contract_type.id, maturity.id, maturity.matures,
+                    book_level.side, book_level.price, book_level.quantity,
+                    book_level.orders, book_level.aon_quantity
+                    FROM book_level JOIN contract_type ON contract_type.id = book_level.contract_type
+                    JOIN maturity ON maturity.id = contract_type.matures
+                    WHERE contract_type.issue = %s
+                    ORDER BY maturity.matures, contract_type.id, book_level.price""",
+        (iid,),
+    )
+    result = []
+    for (cid, mid, matures, side, price, quantity, orders, aon) in curs.fetchall():
+        if not result or result[-1]["contract_type"] != cid:
+            result.append(
+                {
+                    "contract_type": cid,
+                    "maturity": mid,
+                    "matures": matures,
+                    True: [],
+                    False: [],
+                }
+            )
+        result[-1][side].append((price, quantity, orders, aon))
+    for levels in result:
+        levels[True].reverse()  # FIXED offers are better the more they offer
+    return result
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
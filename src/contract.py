@@ -3,10 +3,15 @@
 # Contract object is the external view where we keep track of forming the contract
 # and position is how it gets persisted in the database (internal view).
 
+import collections
 import logging
 
 import psycopg2
+import psycopg2.extras
 
+import auction
+from account import Account
+from book import BookEntry
 from issue import Issue
 from maturity import Maturity
 
@@ -55,63 +60,75 @@ class Contract(object):
             refund_units = min(abs(old_q), abs(new_contract))
         return (new_q, refund_units)
 
+    @classmethod
+    def net(cls, old_q, old_basis, pos_price, quantity):
+        """
+        Add quantity units at pos_price to a position of old_q units with basis
+        old_basis.  Return the new quantity, the new basis and the refund in
+        units.  A position that nets out to nothing is deleted, basis and all.
+        """
+        (new_q, refund) = cls.q_and_refund(old_q, quantity)
+        new_basis = old_basis + (pos_price * abs(quantity)) - (refund * 1000)
+        if new_basis < 0 or not new_q:
+            new_basis = 0
+        return (new_q, new_basis, refund)
+
     # Sign of the quantity variable determines which side: positive is fixed and
     # negative is unfixed. Once the contract object is persisted to the Database
     # that contract object does not exist anymore, we just store positions internally.
     # basis keeps track of what price you paid for what position. Any offsetting
     # is taken care of here. Resolve simply resolves what exists and does not
     # care about history.
-    def persist_side(self, contract_type, acct, pos_price, quantity, curs):
+    @classmethod
+    def persist_all(cls, curs, contracts):
         """
-        Store one side of a contract.
-        This can result in creating a new position, updating an old position,
-        or cancelling out a position.
-
-        The pos_price argument here is the amount paid for this side, per unit.
-        This is a unit price per unit not a "price of the FIXED side" as in
-        other functions.
+        Store a list of contracts on one contract type, as if each one had been
+        persisted in turn, but with one read of the positions involved and
+        one write for the lot.  Sets the refunds on each contract, which are in
+        units.  A position that nets out to nothing is deleted, and any other
+        is inserted or updated.
         """
-        old_q = 0
-        old_basis = 0
+        if not contracts:
+            return contracts
+        contract_type = contracts[0].contract_type
+        accounts = set()
+        for con in contracts:
+            accounts.update((con.fixed_holder, con.unfixed_holder))
         curs.execute(
-            "SELECT quantity, basis FROM position WHERE contract_type = %s AND account = %s",
-            (contract_type.id, acct),
+            """SELECT account, quantity, basis FROM position
+                        WHERE contract_type = %s AND account = ANY(%s) FOR UPDATE""",
+            (contract_type.id, sorted(accounts)),
         )
-        if curs.rowcount == 1:
-            (old_q, old_basis) = curs.fetchone()
-        (new_q, refund) = self.q_and_refund(old_q, quantity)
-        new_basis = old_basis + (pos_price * abs(quantity)) - (refund * 1000)
-        if new_basis < 0:
-            new_basis = 0
-        if old_q and new_q:
-            curs.execute(
-                "UPDATE position SET quantity = %s, basis = %s WHERE contract_type = %s AND account = %s",
-                (new_q, new_basis, contract_type.id, acct),
+        positions = dict.fromkeys(accounts, (0, 0))
+        for (acct, q, basis) in curs.fetchall():
+            positions[acct] = (q, basis)
+        for con in contracts:
+            (q, basis, con.fixed_refund) = cls.net(
+                *positions[con.fixed_holder], con.price, con.quantity
             )
-        elif new_q:
-            curs.execute(
-                "INSERT INTO position (contract_type, account, basis, quantity) VALUES (%s, %s, %s, %s)",
-                (contract_type.id, acct, new_basis, new_q),
+            positions[con.fixed_holder] = (q, basis)
+            (q, basis, con.unfixed_refund) = cls.net(
+                *positions[con.unfixed_holder], 1000 - con.price, -1 * con.quantity
             )
-        else:
-            curs.execute(
-                "DELETE FROM position WHERE contract_type = %s AND account = %s",
-                (contract_type.id, acct),
-            )
-        return refund
-
-    def persist(self, curs):
-        self.fixed_refund = self.persist_side(
-            self.contract_type, self.fixed_holder, self.price, self.quantity, curs
-        )
-        self.unfixed_refund = self.persist_side(
-            self.contract_type,
-            self.unfixed_holder,
-            1000 - self.price,
-            -1 * self.quantity,
+            positions[con.unfixed_holder] = (q, basis)
+        psycopg2.extras.execute_values(
             curs,
+            """WITH new (contract_type, account, basis, quantity) AS (VALUES %s),
+                        gone AS (DELETE FROM position USING new
+                            WHERE position.contract_type = new.contract_type
+                            AND position.account = new.account AND new.quantity = 0)
+                        INSERT INTO position (contract_type, account, basis, quantity)
+                        SELECT contract_type, account, basis, quantity FROM new
+                        WHERE quantity != 0
+                        ON CONFLICT (account, contract_type)
+                        DO UPDATE SET basis = EXCLUDED.basis, quantity = EXCLUDED.quantity""",
+            [
+                (contract_type.id, acct, basis, q)
+                for (acct, (q, basis)) in sorted(positions.items())
+            ],
+            page_size=len(positions),
         )
-        return self
+        return contracts
 
 
 class ContractType(object):
@@ -161,13 +178,58 @@ class ContractType(object):
         result = []
         with cls.db.conn.cursor() as curs:
             curs.execute(
-                """SELECT DISTINCT maturity.matures, maturity.id, issue.url, issue.title, issue.id, contract_type.id
+                """SELECT DISTINCT maturity.matures, maturity.id, issue.url, issue.title, issue.id,
+                            issue.open, contract_type.id
                             FROM maturity JOIN contract_type on maturity.id = contract_type.matures
                             JOIN issue ON issue.id = contract_type.issue
                             JOIN position ON contract_type.id = position.contract_type
                             WHERE maturity.matures < NOW()
                             ORDER BY maturity.matures"""
             )
+            for row in curs.fetchall():
+                (matures, mid, url, title, iid, is_open, cid) = row
+                issue = Issue(url=url, iid=iid, title=title, is_open=is_open)
+                maturity = Maturity(matures, mid)
+                result.append(cls(issue, maturity, cid))
+        return result
+
+    @classmethod
+    def due(cls):
+        """
+        Queued contract types that have matured, with the side that each one
+        resolves to: (contract type, side) pairs.
+        """
+        result = []
+        with cls.db.conn.cursor() as curs:
+            curs.execute(
+                """SELECT maturity.matures, maturity.id, issue.url, issue.title, issue.id,
+                            issue.open, contract_type.id, resolution.side
+                            FROM resolution JOIN contract_type ON contract_type.id = resolution.contract_type
+                            JOIN maturity ON maturity.id = contract_type.matures
+                            JOIN issue ON issue.id = contract_type.issue
+                            WHERE maturity.matures <= NOW()
+                            ORDER BY maturity.matures, contract_type.id"""
+            )
+            for row in curs.fetchall():
+                (matures, mid, url, title, iid, is_open, cid, side) = row
+                issue = Issue(url=url, iid=iid, title=title, is_open=is_open)
+                maturity = Maturity(matures, mid)
+                result.append((cls(issue, maturity, cid), side))
+            curs.connection.commit()
+        return result
+
+    @classmethod
+    def auctions(cls):
+        "Contract types in auction mode that have not matured."
+        result = []
+        with cls.db.conn.cursor() as curs:
+            curs.execute(
+                """SELECT maturity.matures, maturity.id, issue.url, issue.title, issue.id, contract_type.id
+                            FROM maturity JOIN contract_type on maturity.id = contract_type.matures
+                            JOIN issue ON issue.id = contract_type.issue
+                            WHERE contract_type.auction AND maturity.matures > NOW()
+                            ORDER BY contract_type.id"""
+            )
             for row in curs.fetchall():
                 (matures, mid, url, title, iid, cid) = row
                 issue = Issue(url=url, iid=iid, title=title)
@@ -175,6 +237,70 @@ class ContractType(object):
                 result.append(cls(issue, maturity, cid))
         return result
 
+    def set_auction(self, auction=True):
+        """
+        Switch this contract type between matching offers as they come in and
+        holding them for a call auction.  Switching auction mode off runs one
+        last auction first, in the same transaction, since nothing would match
+        the offers waiting on the book after that.
+        """
+        with self.db.conn.cursor() as curs:
+            try:
+                if not auction:
+                    self.clear(db_cursor=curs)
+                curs.execute(
+                    "UPDATE contract_type SET auction = %s WHERE id = %s",
+                    (auction, self.id),
+                )
+                self.db.messages.flush(curs)
+                self.db.books.commit(curs)
+            except Exception:
+                self.db.messages.clear()
+                self.db.books.abort(curs)
+                raise
+        return self
+
+    def clear(self, db_cursor=None):
+        """
+        Run a call auction: match the offers waiting on this contract type's
+        book at the single price that matches the most units, and form all
+        the contracts at that price.  This can be called with or without a
+        database cursor.  Without one, the transaction is committed and the
+        resulting messages returned.
+        """
+        if db_cursor is None:  # Top level in this transaction
+            with self.db.conn.cursor() as curs:
+                try:
+                    self.clear(db_cursor=curs)
+                    result = self.db.messages.flush(curs)
+                    self.db.books.commit(curs)
+                except Exception:
+                    self.db.messages.clear()
+                    self.db.books.abort(curs)
+                    raise
+            return result
+        curs = db_cursor
+        book = self.db.books.get(curs, self.id)
+        curs.execute(
+            """SELECT id, account, side, price, quantity, all_or_nothing, created, expires
+                        FROM offer WHERE contract_type = %s ORDER BY created, id""",
+            (self.id,),
+        )
+        offers = [BookEntry(*row) for row in curs.fetchall()]
+        offers = [entry for entry in offers if not entry.expired(book.now)]
+        (price, fixed_fills, unfixed_fills) = auction.clearing(offers)
+        if price is None:
+            return None
+        balances = self.db.offer.take(curs, book, fixed_fills + unfixed_fills)
+        contracts = []
+        for (fixed, unfixed, quantity) in auction.pair(fixed_fills, unfixed_fills):
+            contracts.append(
+                Contract(self, fixed.account, unfixed.account, price, quantity)
+            )
+        balances.update(self.db.offer.make_contracts(curs, contracts))
+        Account.add_balances(curs, balances)
+        return price
+
     @classmethod
     def lookup(cls, iid, mid):
         with cls.db.conn.cursor() as curs:
@@ -196,6 +322,43 @@ class ContractType(object):
             maturity = Maturity(matures, mid)
             return cls(issue, maturity, cid)
 
+    @classmethod
+    def lookup_many(cls, pairs, curs):
+        """
+        Look up, or create, the contract types for a list of (issue id,
+        maturity id) pairs in two statements.  Returns a dict keyed by pair.
+        The contract types are not locked, so the caller can lock them in
+        whatever order it needs.  This does not commit.
+        """
+        pairs = sorted(set((int(iid), int(mid)) for (iid, mid) in pairs))
+        result = {}
+        if not pairs:
+            return result
+        psycopg2.extras.execute_values(
+            curs,
+            """INSERT INTO contract_type (issue, matures) VALUES %s
+                        ON CONFLICT (issue, matures) DO NOTHING""",
+            pairs,
+            page_size=len(pairs),
+        )
+        rows = psycopg2.extras.execute_values(
+            curs,
+            """SELECT contract_type.id, contract_type.issue, contract_type.matures,
+                            maturity.matures, issue.url, issue.title
+                            FROM contract_type JOIN maturity ON maturity.id = contract_type.matures
+                            JOIN issue ON issue.id = contract_type.issue
+                            WHERE (contract_type.issue, contract_type.matures) IN (VALUES %s)""",
+            pairs,
+            page_size=len(pairs),
+            fetch=True,
+        )
+        for row in rows:
+            (cid, iid, mid, matures, url, title) = row
+            issue = Issue(url=url, iid=iid, title=title)
+            maturity = Maturity(matures, mid)
+            result[(iid, mid)] = cls(issue, maturity, cid)
+        return result
+
     @classmethod
     def cleanup(cls, contract_types=[]):
         "Remove contract types that are no longer in use."
@@ -211,72 +374,86 @@ class ContractType(object):
             for row in curs.fetchall():
                 expired.append(row[0])
         for cid in expired:
-            try:
-                with cls.db.conn.cursor() as curs:
-                    curs.execute("DELETE FROM contract_type WHERE id = %s", (cid,))
-                    cls.db.conn.commit()
-            except psycopg2.errors.ForeignKeyViolation:
-                cls.db.conn.rollback()
+            cls.discard(cid)
+
+    @classmethod
+    def discard(cls, cid):
+        "Delete a contract type, unless something still refers to it."
+        try:
+            with cls.db.conn.cursor() as curs:
+                curs.execute("DELETE FROM contract_type WHERE id = %s", (cid,))
+                cls.db.conn.commit()
+        except psycopg2.errors.ForeignKeyViolation:
+            cls.db.conn.rollback()
 
     def resolve(self, side):
         """
         True = fixed, False = unfixed.
+
+        Cancel the offers on this contract type and settle every position on
+        it, in one transaction that takes the same few statements however
+        many positions there are.  Then remove the contract type if nothing
+        refers to it; one with messages or trades is kept, for them.
         """
-        total = 0
-        result = []
-        self.db.cleanup(contract_types=[self])
         with self.db.conn.cursor() as curs:
-            while True:
+            try:
+                self.db.books.get(curs, self.id)
+                self.db.offer.mass_cancel(
+                    contract_type=self, text=self.db.offer.expired_text, db_cursor=curs
+                )
                 curs.execute(
-                    """SELECT id, account, basis, quantity FROM position
-                             WHERE contract_type = %s LIMIT 1""",
+                    """DELETE FROM position WHERE contract_type = %s
+                                RETURNING id, account, basis, quantity""",
                     (self.id,),
                 )
-                if curs.rowcount == 0:
-                    break
-                (pid, account, basis, quantity) = curs.fetchone()
-                total += quantity
-                position_side = False
-                if quantity > 0:
-                    position_side = True
-                quantity = abs(quantity)
-                if (position_side and side) or ((not position_side) and (not side)):
-                    # Winner
-                    # Oracle fee is 10% of the profit, rounded to the nearest token, minimum 1 token.
-                    fee_tokens = ((quantity * 1000 - basis) * 0.1) / 1000
-                    fee = 1000 * max(1, round(fee_tokens))
-                    payout = max(0, quantity * 1000 - fee)
+                positions = sorted(curs.fetchall())
+                # Total is always 0.
+                if sum(row[3] for row in positions) != 0:
+                    raise RuntimeError
+                payouts = collections.Counter()
+                for (pid, account, basis, quantity) in positions:
+                    position_side = quantity > 0
+                    quantity = abs(quantity)
+                    if position_side == side:
+                        # Winner
+                        # Oracle fee is 10% of the profit, rounded to the nearest token, minimum 1 token.
+                        fee_tokens = ((quantity * 1000 - basis) * 0.1) / 1000
+                        fee = 1000 * max(1, round(fee_tokens))
+                        payout = max(0, quantity * 1000 - fee)
+                        payouts[account] += payout
+                        self.db.messages.add(
+                            "contract_resolved",
+                            account,
+                            self,
+                            side=position_side,
+                            price=1000,
+                            quantity=payout / 1000,
+                        )
+                    else:
+                        # Loser.
+                        self.db.messages.add(
+                            "contract_resolved",
+                            account,
+                            self,
+                            side=position_side,
+                            price=0,
+                            quantity=quantity,
+                        )
+                units = sum(row[3] for row in positions if row[3] > 0)
+                if units:
                     curs.execute(
-                        "UPDATE account SET balance = balance + %s WHERE id = %s",
-                        (payout, account),
-                    )
-                    self.db.messages.add(
-                        "contract_resolved",
-                        account,
-                        self,
-                        side=position_side,
-                        price=1000,
-                        quantity=payout / 1000,
-                    )
-                else:
-                    # Loser.
-                    self.db.messages.add(
-                        "contract_resolved",
-                        account,
-                        self,
-                        side=position_side,
-                        price=0,
-                        quantity=quantity,
+                        """INSERT INTO trade (class, contract_type, price, quantity)
+                                    VALUES ('contract_resolved', %s, %s, %s)""",
+                        (self.id, 1000 if side else 0, units),
                     )
-                # Done with this position, delete it.
-                curs.execute("DELETE from position WHERE id = %s", (pid,))
-            # Done with all positions.  Total is always 0.
-            if total != 0:
-                raise RuntimeError
-            result = self.db.messages.flush(curs)
-            curs.connection.commit()
-
-        self.db.cleanup(contract_types=[self])
+                Account.add_balances(curs, payouts)
+                result = self.db.messages.flush(curs)
+                self.db.books.commit(curs)
+            except Exception:
+                self.db.messages.clear()
+                self.db.books.abort(curs)
+                raise
+        self.discard(self.id)
         return result
 
 
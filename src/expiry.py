@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Offers are cancelled when they come due: at their expiration time, or at
+# the maturity date of their contract type, whichever comes first. Until then
+# they just stop showing up (Offer.filter) and stop matching (OrderBook), so
+# reading offers never has to write anything.
+
+import heapq
+import logging
+import threading
+import time
+
+
+class Expiry(object):
+    """
+    Keeps a heap of the time the next offer comes due on each contract type,
+    so that checking whether anything needs to be done costs nothing, and
+    cancelling only touches contract types with offers that are due.
+
+    Offers placed by other processes aren't seen here, so the heap is rebuilt
+    from the database every refresh_interval seconds.
+    """
+
+    interval = 60  # seconds between checks in poll()
+    refresh_interval = 600
+
+    def __init__(self, db):
+        self.db = db
+        self.heap = []  # (due, contract type id), possibly stale
+        self.due = {}  # contract type id: when its next offer is due
+        self.lock = threading.Lock()
+        self.next_poll = 0
+        self.next_refresh = 0
+
+    def schedule(self, cid, *times):
+        "Note that an offer on contract type cid comes due at the earliest of times."
+        times = [t for t in times if t is not None]
+        if not times:
+            return
+        due = min(times)
+        with self.lock:
+            if cid in self.due and self.due[cid] <= due:
+                return
+            self.due[cid] = due
+            heapq.heappush(self.heap, (due, cid))
+
+    def refresh(self, curs):
+        "Rebuild the heap from the offers in the database."
+        curs.execute(
+            """SELECT contract_type.id, maturity.matures
+                        FROM contract_type JOIN maturity ON maturity.id = contract_type.matures
+                        WHERE EXISTS (SELECT 1 FROM book_level
+                                      WHERE book_level.contract_type = contract_type.id)
+                        UNION ALL
+                        SELECT contract_type, MIN(expires) FROM offer
+                        WHERE expires IS NOT NULL GROUP BY contract_type"""
+        )
+        rows = curs.fetchall()
+        with self.lock:
+            self.heap = []
+            self.due = {}
+        for (cid, due) in rows:
+            self.schedule(cid, due)
+        self.next_refresh = time.monotonic() + self.refresh_interval
+
+    def pop_due(self, now):
+        "Take the contract types with offers due by now off the heap."
+        result = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                (due, cid) = heapq.heappop(self.heap)
+                if self.due.get(cid) == due:
+                    del self.due[cid]
+                    result.append(cid)
+        return sorted(result)
+
+    def run(self):
+        """
+        Cancel every offer that is due, one contract type per transaction.
+        A contract type that fails is logged and tried again on the next run,
+        without holding up the others.  Returns the resulting messages.
+        """
+        with self.db.conn.cursor() as curs:
+            if time.monotonic() >= self.next_refresh:
+                self.refresh(curs)
+            curs.execute("SELECT LOCALTIMESTAMP")
+            now = curs.fetchone()[0]
+            curs.connection.commit()
+        result = []
+        for cid in self.pop_due(now):
+            try:
+                result.extend(self.expire(cid))
+            except Exception as e:
+                logging.error(
+                    "Failed to cancel expired offers on contract type %d: %s" % (cid, e)
+                )
+                self.schedule(cid, now)
+        return result
+
+    def expire(self, cid):
+        "Cancel the offers that are due on one contract type, and schedule the next."
+        with self.db.conn.cursor() as curs:
+            try:
+                self.db.offer.expire(curs, cid)
+                curs.execute(
+                    """SELECT LEAST(MIN(offer.expires), maturity.matures) FROM offer
+                                JOIN contract_type ON contract_type.id = offer.contract_type
+                                JOIN maturity ON maturity.id = contract_type.matures
+                                WHERE offer.contract_type = %s GROUP BY maturity.matures""",
+                    (cid,),
+                )
+                if curs.rowcount:
+                    self.schedule(cid, curs.fetchone()[0])
+                result = self.db.messages.flush(curs)
+                self.db.books.commit(curs)
+            except Exception:
+                self.db.messages.clear()
+                self.db.books.abort(curs)
+                raise
+        return result
+
+    def poll(self):
+        """
+        Run if it has been at least interval seconds since the last time.
+        This is cheap enough to call on every request.
+        """
+        if time.monotonic() < self.next_poll:
+            return []
+        self.next_poll = time.monotonic() + self.interval
+        try:
+            return self.run()
+        except Exception as e:
+            logging.error("Failed to cancel expired offers: %s" % e)
+            return []
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
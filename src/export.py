@@ -13,7 +13,7 @@ def dump_csv(db):
     with db.conn.cursor() as curs:
         curs.execute(
             """SELECT created, url, matures, class, side, price, quantity
-                        FROM ticker ORDER BY created;
+                        FROM ticker ORDER BY created, id;
                      """
         )
         for row in curs.fetchall():
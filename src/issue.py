@@ -131,11 +131,11 @@ class Issue(object):
         with db.conn.cursor() as curs:
             curs.execute(
                 """SELECT issue.id, issue.modified, issue.url, issue.title, issue.open,
-                            SUM(offer.quantity)
+                            SUM(book_level.quantity)
                             FROM issue LEFT OUTER JOIN contract_type ON contract_type.issue = issue.id
-                            LEFT OUTER JOIN offer ON offer.contract_type = contract_type.id
+                            LEFT OUTER JOIN book_level ON book_level.contract_type = contract_type.id
                             GROUP BY issue.id
-                            ORDER BY SUM(offer.quantity) DESC NULLS LAST,
+                            ORDER BY SUM(book_level.quantity) DESC NULLS LAST,
                             open DESC,
                             modified DESC"""
             )
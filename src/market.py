@@ -1,9 +1,12 @@
+import concurrent.futures
 from datetime import timezone
 import logging
 import os
+import queue
 import signal
 import subprocess
 import sys
+import threading
 import time
 
 try:
@@ -16,12 +19,15 @@ except:
 
 import config
 from account import Account
+from book import BookCache, depth
 from contract import Contract, ContractType, Issue, Maturity
+from expiry import Expiry
 from export import dump_csv
 from graph import Graph
 from message import Message, MessageList
 from offer import Offer
 from position import Position
+import valuation
 
 
 def pg_version():
@@ -53,7 +59,9 @@ class Market(object):
         else:
             self.logging = logging
         self.system_id = None
-        self.messages = MessageList(self)
+        self.local = threading.local()
+        self.books = BookCache(self)
+        self.expiry = Expiry(self)
         self.contract_type = ContractType
         self.contract_type.db = self
         self.offer = Offer
@@ -64,15 +72,49 @@ class Market(object):
         self.history.db = self
         self.graph = Graph
         self.graph.db = self
-        self.connect()
         with self.conn.cursor() as curs:
             curs.execute("SELECT id FROM account WHERE system = true")
             self.system_id = int(curs.fetchone()[0])
 
+    # Each thread (a request worker in the web application, for example) gets
+    # its own database connection and its own list of messages waiting to be
+    # sent, so that transactions in different threads don't get mixed up.
+    @property
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None or conn.closed:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    @property
+    def messages(self):
+        messages = getattr(self.local, "messages", None)
+        if messages is None:
+            messages = self.local.messages = MessageList(self)
+        return messages
+
+    # Portfolio summaries by account id (see Account.portfolio), kept while
+    # this thread handles a request.  Pages look at the same account's
+    # balance several times, so a summary is kept until the thread commits or
+    # rolls back, or the request ends.  Outside a request nothing is kept,
+    # since other threads and processes can change balances at any time.
+    @property
+    def portfolios(self):
+        return getattr(self.local, "portfolios", None)
+
+    def cache_portfolios(self):
+        "Keep portfolio summaries in this thread, from the start of a request."
+        self.local.portfolios = {}
+
+    def forget_portfolios(self):
+        "Drop this thread's cached portfolio summaries."
+        if self.portfolios is not None:
+            self.portfolios.clear()
+
     def connect(self):
         for i in range(5):
             try:
-                self.conn = psycopg2.connect(
+                conn = psycopg2.connect(
                     dbname=config.DB_NAME,
                     user=config.DB_USER,
                     host=config.DB_HOST,
@@ -81,13 +123,29 @@ class Market(object):
                 )
                 if i > 0:
                     logging.info("Connected to database after %d attempt(s)." % i)
-                break
+                return conn
             except psycopg2.OperationalError:
                 logging.info("Waiting for database.")
                 time.sleep(2 ** (i + 3))
-        else:
-            logging.error("Database connection failed")
-            raise RuntimeError
+        logging.error("Database connection failed")
+        raise RuntimeError
+
+    def disconnect(self):
+        "Close the database connection for this thread."
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def end_transaction(self):
+        """
+        Roll back anything this thread has left open, such as reads, and stop
+        keeping portfolio summaries, at the end of a request.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and not conn.closed:
+            conn.rollback()
+        self.local.portfolios = None
 
     def now(self):
         with self.conn.cursor() as curs:
@@ -102,6 +160,7 @@ class Market(object):
                 "UPDATE account set balance = balance + 10000000 WHERE balance < 10000000"
             )
             curs.connection.commit()
+        self.forget_portfolios()
 
     def lookup_user(self, host, sub, username=None, profile=None, starting_balance=0):
         # FIXME Transaction management
@@ -117,6 +176,7 @@ class Market(object):
         ContractType.cleanup(contract_types)
         Maturity.cleanup(self)
         Issue.cleanup(self)
+        self.history.add_partitions()
 
     def add_issue(self, user, issue_url):
         return Issue(url=issue_url).persist(self)
@@ -139,6 +199,252 @@ class Market(object):
                 result.append(message)
         return result
 
+    def cancel_offers(
+        self, user, contract_type=None, issue=None, maturity=None, side=None
+    ):
+        """
+        Cancel all of a user's offers, or those on a contract type, issue,
+        maturity or side, in one transaction.  Returns the user's messages.
+        """
+        messages = Offer.mass_cancel(
+            account=user,
+            contract_type=contract_type,
+            issue=issue,
+            maturity=maturity,
+            side=side,
+        )
+        return [message for message in messages if message.account == user.id]
+
+    def amend_offer(self, user, oid, price=None, quantity=None):
+        """
+        Change the price and/or quantity of one of a user's offers.  Returns
+        the user's messages.
+        """
+        offer = Offer.by_id(oid)
+        if offer is None:
+            return []
+        messages = offer.amend(price, quantity, user=user)
+        return [message for message in messages if message.account == user.id]
+
+    def place_orders(self, user, orders):
+        """
+        Place a batch of offers for one user in a single transaction, for
+        example a ladder of offers at several prices.  Each order is a dict
+        with issue, maturity, side, price and quantity, and optionally
+        all_or_nothing and expires.  Returns the user's messages for each
+        order, in order.  If any order fails, none of them are placed.
+        """
+        orders = list(orders)
+        spans = []
+        with self.conn.cursor() as curs:
+            try:
+                ctypes = self.contract_type.lookup_many(
+                    [(o["issue"], o["maturity"]) for o in orders], curs
+                )
+                # Lock the books in id order, as every other path that locks
+                # several of them does, so that they can't deadlock.
+                for cid in sorted(set(ctype.id for ctype in ctypes.values())):
+                    self.books.get(curs, cid)
+                for order in orders:
+                    ctype = ctypes[(int(order["issue"]), int(order["maturity"]))]
+                    start = len(self.messages)
+                    Offer(
+                        user,
+                        ctype,
+                        order["side"],
+                        order["price"],
+                        order["quantity"],
+                        all_or_nothing=order.get("all_or_nothing", False),
+                        expires=order.get("expires"),
+                    ).place(db_cursor=curs)
+                    spans.append((start, len(self.messages)))
+                messages = self.messages.flush(curs)
+                self.books.commit(curs)
+            except Exception:
+                self.messages.clear()
+                self.books.abort(curs)
+                raise
+        result = []
+        for (start, end) in spans:
+            result.append([m for m in messages.data[start:end] if m.account == user.id])
+        return result
+
+    def depth(self, issue):
+        """
+        The order book for an issue added up by price level, without reading
+        the individual offers.  See book.depth.
+        """
+        with self.conn.cursor() as curs:
+            return depth(curs, issue.id)
+
+    def clear_auctions(self):
+        """
+        Run the call auction on every contract type in auction mode, each in
+        its own transaction.  Returns the resulting messages.
+        """
+        result = []
+        for ctype in self.contract_type.auctions():
+            result.extend(ctype.clear())
+        return result
+
+    def resolve_all(self, resolutions=None, workers=8, retries=3):
+        """
+        Resolve many contract types at once, each in its own transaction, on a
+        pool of worker threads.  resolutions is a list of (contract type,
+        side) pairs, or a mapping, with True for FIXED.  By default every
+        resolvable contract type is resolved, as FIXED if its issue has been
+        closed and UNFIXED if it is still open.  A resolution that deadlocks
+        with another transaction is tried again, up to retries tries in all.
+        Returns the messages, and a list of (contract type, error) for those
+        that failed.
+        """
+        if retries < 1:
+            raise ValueError("Each resolution needs at least one try, not %s" % retries)
+        if resolutions is None:
+            resolutions = [
+                (ctype, not ctype.issue.is_open)
+                for ctype in self.contract_type.resolvable()
+            ]
+        elif hasattr(resolutions, "items"):
+            resolutions = resolutions.items()
+        pending = queue.Queue()
+        for item in resolutions:
+            pending.put(item)
+        total = pending.qsize()
+        (messages, failures, done, lock) = ([], [], [], threading.Lock())
+
+        def work():
+            try:
+                while True:
+                    try:
+                        (ctype, side) = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    for attempt in range(retries):
+                        try:
+                            result = ctype.resolve(side)
+                            error = None
+                            break
+                        except psycopg2.extensions.TransactionRollbackError as e:
+                            error = e
+                        except Exception as e:
+                            error = e
+                            break
+                    with lock:
+                        if error is None:
+                            messages.extend(result)
+                        else:
+                            logging.error("Failed to resolve %s: %s" % (ctype, error))
+                            failures.append((ctype, error))
+                        done.append(ctype)
+                        logging.info(
+                            "Resolved %d of %d contract types" % (len(done), total)
+                        )
+            finally:
+                self.disconnect()  # each worker has its own connection
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for i in range(min(workers, total)):
+                pool.submit(work)
+        # The workers committed on their own connections, not this thread's.
+        self.forget_portfolios()
+        return (messages, failures)
+
+    def resolve_due(self, workers=8):
+        """
+        Resolve the queued contract types that have matured, each on the side
+        that the state of its issue says, and take them off the queue (see
+        the resolution table in schema.sql).  Returns the messages and the
+        failures, as resolve_all does.
+        """
+        due = self.contract_type.due()
+        (messages, failures) = self.resolve_all(due, workers)
+        failed = set(ctype.id for (ctype, error) in failures)
+        done = [ctype.id for (ctype, side) in due if ctype.id not in failed]
+        with self.conn.cursor() as curs:
+            curs.execute(
+                "DELETE FROM resolution WHERE contract_type = ANY(%s)", (done,)
+            )
+            curs.connection.commit()
+        return (messages, failures)
+
+    def valuation(self, account=None):
+        """
+        Every position, or one account's, marked to market: a dict by account
+        id of positions, units, basis, value and pnl.  See valuation.py.
+        """
+        with self.conn.cursor() as curs:
+            result = valuation.value(curs, account.id if account else None)
+            curs.connection.commit()
+        return result
+
+    def quote(self, user, contract_type, bid, ask, size):
+        """
+        Replace a user's two-sided quote on a contract type: a FIXED offer at
+        the bid and an UNFIXED offer at the ask, each for size units, with
+        prices in millitokens.  Returns the user's messages.
+        """
+        quote = {"contract_type": contract_type, "bid": bid, "ask": ask, "size": size}
+        return self.quotes(user, [quote])[0]
+
+    def quotes(self, user, quotes):
+        """
+        Replace a user's quotes on many contract types in one transaction.
+        Each quote is a dict with bid, ask and size, and either contract_type
+        or issue and maturity ids.  A bid or ask of None, or a size of 0,
+        leaves that side empty.  The bid must be below the ask, or the quote
+        would match itself.  Returns the user's messages for each quote, in
+        order.  If any quote fails, none of them change.
+        """
+        quotes = [dict(quote) for quote in quotes]  # not the caller's
+        for quote in quotes:
+            (bid, ask) = (quote.get("bid"), quote.get("ask"))
+            if bid is not None and ask is not None and bid >= ask:
+                raise ValueError("Bid %s is not below ask %s" % (bid, ask))
+        spans = []
+        with self.conn.cursor() as curs:
+            try:
+                ctypes = self.contract_type.lookup_many(
+                    [
+                        (q["issue"], q["maturity"])
+                        for q in quotes
+                        if q.get("contract_type") is None
+                    ],
+                    curs,
+                )
+                for quote in quotes:
+                    if quote.get("contract_type") is None:
+                        key = (int(quote["issue"]), int(quote["maturity"]))
+                        quote["contract_type"] = ctypes[key]
+                # Lock the books in a consistent order, as in place_orders.
+                for cid in sorted(set(q["contract_type"].id for q in quotes)):
+                    self.books.get(curs, cid)
+                for quote in quotes:
+                    start = len(self.messages)
+                    ctype = quote["contract_type"]
+                    Offer.mass_cancel(
+                        account=user, contract_type=ctype, quote=True, db_cursor=curs
+                    )
+                    for (side, price) in (
+                        (self.FIXED, quote.get("bid")),
+                        (self.UNFIXED, quote.get("ask")),
+                    ):
+                        if price is not None and quote.get("size"):
+                            Offer(
+                                user, ctype, side, price, quote["size"], quote=True
+                            ).place(db_cursor=curs)
+                    spans.append((start, len(self.messages)))
+                messages = self.messages.flush(curs)
+                self.books.commit(curs)
+            except Exception:
+                self.messages.clear()
+                self.books.abort(curs)
+                raise
+        result = []
+        for (start, end) in spans:
+            result.append([m for m in messages.data[start:end] if m.account == user.id])
+        return result
+
     def setup(self):
         Maturity.make_upcoming(self)
 
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
 import collections
-import logging
+import datetime
+import gzip
+import os
+import time
+
+import psycopg2.errors
+import psycopg2.extras
 
 # from the file, import the class
 from issue import Issue
@@ -35,17 +41,29 @@ class Message(object):
         self.expires = expires
         self.offer = offer
         self.contract = contract
-        self.text = text
+        self.stored_text = text  # free text, or what was stored before templates
         self.created = created
+        self.rendered = None  # text made from the fields, once it is needed
 
     @property
     # converting price to tokens from millitokens (for display)
     def displayprice(self):
         return "%.3f" % (self.price / 1000)
 
+    page_size = 50
+
     @classmethod
-    def filter(cls, account=None, issue=None, ticker=False):
-        all_events = not ticker
+    def filter(cls, account=None, issue=None, ticker=False, before=None, limit=None):
+        """
+        Messages, newest first, and in the order they were sent within a
+        transaction.  For a page at a time, give a limit, and to get the next
+        page, the last message on this one as before.  Its created time limits
+        the search to the months before it.
+        With ticker, the trades on the market, for any account.
+        """
+        keyset = (None, None, None, None)
+        if before is not None:
+            keyset = (before.created, before.created, before.created, before.id)
         (all_accounts, all_issues) = (False, False)
         if issue:
             iid = issue.id
@@ -58,22 +76,38 @@ class Message(object):
             uid = None
             all_accounts = True
 
+        if ticker:
+            # Market data, from the trade tape rather than everyone's messages.
+            query = """SELECT issue, url, title, maturity, matures,
+                        id, class, created,
+                        contract_type, side, price, quantity, NULL, NULL
+                        FROM ticker
+                        WHERE (%s OR issue = %s)
+                        AND quantity > 0
+                        AND (%s::timestamp IS NULL OR
+                            (created <= %s AND (created < %s OR id > %s)))
+                        ORDER BY created DESC, id
+                        LIMIT %s"""
+            args = (all_issues, iid) + keyset + (limit,)
+        else:
+            query = """SELECT issue, url, title, maturity, matures,
+                        id, class, created,
+                        contract_type, side, price, quantity, expires, message
+                        FROM message_overview
+                        WHERE (%s OR issue = %s)
+                        AND (%s OR recipient = %s)
+                        AND (%s::timestamp IS NULL OR
+                            (created <= %s AND (created < %s OR id > %s)))
+                        ORDER BY created DESC, id
+                        LIMIT %s"""
+            args = (all_issues, iid, all_accounts, uid) + keyset + (limit,)
         result = []
         with cls.db.conn.cursor() as curs:
-            curs.execute(
-                """SELECT issue, url, title, maturity, matures,
-                            id, class, created,
-                            contract_type, side, price, quantity, expires, message
-                            FROM message_overview
-                            WHERE (%s OR issue = %s)
-                            AND (%s OR recipient = %s)
-                            AND (%s OR (side = true AND
-                                (class = 'contract_created' OR class = 'contract_resolved')
-                                AND quantity > 0))
-                            ORDER BY created DESC""",
-                (all_issues, iid, all_accounts, uid, all_events),
-            )
-            for row in curs.fetchall():
+            curs.execute(query, args)
+            rows = curs.fetchall()
+            # End the read, so that it holds no locks on the message table.
+            curs.connection.commit()
+            for row in rows:
                 (
                     iid,
                     url,
@@ -116,81 +150,160 @@ class Message(object):
                 )
             return result
 
-    # send takes a cursor because Messages are only sent as the result of
-    # a transaction.  Send does not commit the transaction. The message is only
-    # sent when a transaction goes through.
-    def send(self, curs, log=False):
-        if self.account is None:
-            curs.execute("SELECT id FROM account WHERE system = true")
-            self.account = curs.fetchone()[0]
+    # The message table is partitioned by month of created (see schema.sql).
+    # Partitions are made this many months ahead, so that new messages go in
+    # one, and whole months are archived once they are old.
+    months_ahead = 3
+
+    # Adding and removing partitions takes strong locks on the message table,
+    # which wait for every open transaction that has read it.  Rather than
+    # wait indefinitely, and hold up everything queued behind, give up after
+    # lock_timeout milliseconds and try again, lock_tries times in all.
+    lock_timeout = 2000
+    lock_tries = 5
+
+    @classmethod
+    def alter_partitions(cls, curs, statements):
+        "Run (statement, args) pairs in one transaction, retrying if a lock times out."
+        for attempt in range(cls.lock_tries):
+            try:
+                curs.execute("SET LOCAL lock_timeout = %s", (cls.lock_timeout,))
+                for (statement, args) in statements:
+                    curs.execute(statement, args)
+                curs.connection.commit()
+                return
+            except psycopg2.errors.LockNotAvailable:
+                curs.connection.rollback()
+                if attempt + 1 == cls.lock_tries:
+                    raise
+                time.sleep(cls.lock_timeout / 1000)
+
+    @classmethod
+    def partitions(cls, curs):
+        "The monthly partitions of the message table, oldest first, as (name, first day)."
+        curs.execute(
+            """SELECT child.relname FROM pg_inherits
+                        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                        WHERE parent.relname = 'message'
+                        AND child.relname ~ '^message_[0-9]{4}_[0-9]{2}$'
+                        ORDER BY child.relname"""
+        )
+        result = []
+        for (name,) in curs.fetchall():
+            (year, month) = name.split("_")[1:]
+            result.append((name, datetime.date(int(year), int(month), 1)))
+        return result
+
+    @classmethod
+    def add_partitions(cls):
+        "Make the partitions for this month and the next few, if they are not there yet."
+        with cls.db.conn.cursor() as curs:
+            cls.alter_partitions(
+                curs,
+                [
+                    (
+                        """SELECT create_message_partition(month::date) FROM generate_series(
+                            date_trunc('month', NOW()), NOW() + %s * INTERVAL '1 month',
+                            INTERVAL '1 month') AS month""",
+                        (cls.months_ahead,),
+                    )
+                ],
+            )
+
+    @classmethod
+    def archive(cls, before, directory):
+        """
+        Archive every month of messages that ends on or before the given day:
+        write it to a gzipped CSV file in directory, then drop its partition.
+        Returns the files written.
+        """
+        result = []
+        with cls.db.conn.cursor() as curs:
+            partitions = cls.partitions(curs)
+            curs.connection.commit()
+            for (name, first) in partitions:
+                following = (first + datetime.timedelta(days=31)).replace(day=1)
+                if following > before:
+                    break
+                path = os.path.join(directory, "%s.csv.gz" % name)
+                with gzip.open(path + ".tmp", "wb") as f:
+                    curs.copy_expert(
+                        "COPY %s TO STDOUT WITH (FORMAT csv, HEADER)" % name, f
+                    )
+                curs.connection.commit()
+                os.replace(path + ".tmp", path)
+                # Dropped without detaching first, which would make its foreign
+                # keys its own, and dropping those locks account and contract_type.
+                cls.alter_partitions(curs, [("DROP TABLE %s" % name, None)])
+                result.append(path)
+        return result
+
+    def row(self):
+        "The values to store for this message, in the order of the message table."
         ctype = None
         if self.contract_type:
             ctype = self.contract_type.id
-        curs.execute(
-            """INSERT INTO message (class, recipient,
-                                           contract_type, side, price, quantity, expires, message)
-                                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                                           RETURNING id""",
-            (
-                self.mclass,
-                self.account,
-                ctype,
-                self.side,
-                self.price,
-                self.quantity,
-                self.expires,
-                str(self),
-            ),
+        return (
+            self.mclass,
+            self.account,
+            ctype,
+            self.side,
+            self.price,
+            self.quantity,
+            self.expires,
+            str(self) if self.mclass in self.free_text else None,
         )
-        self.id = curs.fetchone()[0]
-        if log:
-            logging.info(self)
-        return self
+
+    @property
+    def text(self):
+        "The text of the message, as it is shown, or None if there is none."
+        try:
+            return str(self)
+        except NotImplementedError:
+            return None
 
     @property
     # time when the message was generated.
     def datetime(self):
         return self.created.strftime("%d %b %H:%M")
 
+    # Messages of these classes are free text.  Messages of every other class
+    # are stored as their fields alone, and the text is made from the fields
+    # when the message is shown, from the template for its class.
+    free_text = ("system", "info", "new_account")
+
+    templates = {
+        "offer_created": "Offer made: {quantity:d} units of {side} on {contract_type} at a (fixed) price of {price:.3f}{expiry}",
+        "offer_cancelled": "Offer cancelled: {quantity:d} units of {side} on {contract_type} at a (fixed) price of {price:.3f}",
+        "offer_amended": "Offer changed: {quantity:d} units of {side} on {contract_type} at a (fixed) price of {price:.3f}",
+        "contract_created": "Contract formed: {quantity:d} units of {side} {contract_type} at a (fixed) price of {price:.3f}",
+        "position_covered": "Contract on {contract_type} had {quantity:d} units covered and tokens returned",
+        "contract_resolved": "Contract resolved: {contract_type} for a payout of {payout:d} tokens",
+    }
+
     def make_text(self):
-        whichside = "UNFIXED"
-        if self.side == True:
-            whichside = "FIXED"
-        if self.mclass == "offer_created":
-            exp = " (never expires)"
-            if self.expires:
-                exp = " (expires %s)" % self.expires.strftime("%d %b %H:%M")
-            return "Offer made: %d units of %s on %s at a (fixed) price of %.3f%s" % (
-                self.quantity,
-                whichside,
-                self.contract_type,
-                self.price / 1000,
-                exp,
-            )
-        if self.mclass == "offer_cancelled":
-            return (
-                "Offer cancelled: %d units of %s on %s at a (fixed) price of %.3f"
-                % (self.quantity, whichside, self.contract_type, self.price / 1000)
-            )
-        if self.mclass == "contract_created":
-            return "Contract formed: %d units of %s %s at a (fixed) price of %.3f" % (
-                self.quantity,
-                whichside,
-                self.contract_type,
-                self.price / 1000,
-            )
-        if self.mclass == "position_covered":
-            return "Contract on %s had %d units covered and tokens returned" % (
-                self.contract_type,
-                self.quantity,
-            )
-        if self.mclass == "contract_resolved":
-            return "Contract resolved: %s for a payout of %d tokens" % (
-                self.contract_type,
-                (self.price * self.quantity) / 1000,
-            )
-        if self.text:
-            return self.text
+        template = self.templates.get(self.mclass)
+        if template is None:
+            return self.stored_text
+        (quantity, price, payout) = (None, None, None)
+        if self.quantity is not None:
+            quantity = int(self.quantity)
+        if self.price is not None:
+            price = self.price / 1000
+            if self.quantity is not None:
+                payout = int((self.price * self.quantity) / 1000)
+        expiry = " (never expires)"
+        if self.expires:
+            expiry = " (expires %s)" % self.expires.strftime("%d %b %H:%M")
+        return template.format(
+            quantity=quantity,
+            side="FIXED" if self.side == True else "UNFIXED",
+            contract_type=self.contract_type,
+            price=price,
+            payout=payout,
+            expiry=expiry,
+        )
 
     @property
     def summary(self):
@@ -219,13 +332,17 @@ class Message(object):
             return self.__repr__()
 
     def __repr__(self):
+        if self.rendered is not None:
+            return self.rendered
         try:
-            return self.make_text()
+            self.rendered = self.make_text()
         except TypeError as err:
-            if self.text:
-                return self.text
+            # Missing fields.  A message stored with its text still has it.
+            if self.stored_text:
+                return self.stored_text
             else:
                 raise NotImplementedError
+        return self.rendered
 
     def __str__(self):
         return self.__repr__()
@@ -278,8 +395,28 @@ class MessageList(collections.UserList):
         return result
 
     def send_all(self, curs):
+        "Store all the messages with one statement, and fill in their ids."
+        if not self.data:
+            return self
+        system_id = getattr(self.market, "system_id", None)
         for m in self:
-            m.send(curs)
+            if m.account is None:
+                if system_id is None:
+                    curs.execute("SELECT id FROM account WHERE system = true")
+                    system_id = curs.fetchone()[0]
+                m.account = system_id
+        rows = [m.row() for m in self]
+        ids = psycopg2.extras.execute_values(
+            curs,
+            """INSERT INTO message (class, recipient,
+                contract_type, side, price, quantity, expires, message)
+                VALUES %s RETURNING id""",
+            rows,
+            page_size=len(rows),
+            fetch=True,
+        )
+        for (m, (mid,)) in zip(self, ids):
+            m.id = mid
         return self
 
     def flush(self, curs):
@@ -289,5 +426,9 @@ class MessageList(collections.UserList):
         self.data = []
         return result
 
+    def clear(self):
+        "Drop the messages from a transaction that failed."
+        self.data = []
+
     def __repr__(self):
         return ", ".join(repr(m) for m in self)
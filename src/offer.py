@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
+import collections
 import logging
 import os
 import sys
 
+import psycopg2.extras
+
 from account import Account
+from book import BookEntry
 from contract import Contract, ContractType, Issue, Maturity
 
 
@@ -49,54 +53,65 @@ class Offer(object):
         if curs.rowcount != 1:
             raise RuntimeError
 
-    def make_contract(
-        self, curs, contract_type, fixed_holder, unfixed_holder, price, quantity
-    ):
-        con = Contract(
-            contract_type, fixed_holder, unfixed_holder, price, quantity
-        ).persist(curs)
-        curs.execute(
-            "UPDATE account SET balance = balance - %s WHERE id = %s",
-            (price * quantity - con.fixed_refund * 1000, fixed_holder),
-        )
-        curs.execute(
-            "UPDATE account SET balance = balance - %s WHERE id = %s",
-            ((1000 - price) * quantity - con.unfixed_refund * 1000, unfixed_holder),
-        )
-        self.db.messages.add(
-            "contract_created",
-            fixed_holder,
-            contract_type,
-            self.db.FIXED,
-            price,
-            quantity,
-            contract=con,
-        )
-        self.db.messages.add(
-            "contract_created",
-            unfixed_holder,
-            contract_type,
-            self.db.UNFIXED,
-            price,
-            quantity,
-            contract=con,
-        )
-        if con.fixed_refund:
-            self.db.messages.add(
-                "position_covered",
-                fixed_holder,
-                contract_type,
-                quantity=con.fixed_refund,
+    @classmethod
+    def make_contracts(cls, curs, contracts):
+        """
+        Persist contracts formed by matching offers, and return the change to
+        each account's balance that they make.
+        """
+        Contract.persist_all(curs, contracts)
+        if contracts:
+            psycopg2.extras.execute_values(
+                curs,
+                "INSERT INTO trade (class, contract_type, price, quantity) VALUES %s",
+                [
+                    ("contract_created", con.contract_type.id, con.price, con.quantity)
+                    for con in contracts
+                ],
+            )
+        balances = collections.Counter()
+        for con in contracts:
+            balances[con.fixed_holder] -= (
+                con.price * con.quantity - con.fixed_refund * 1000
+            )
+            balances[con.unfixed_holder] -= (
+                1000 - con.price
+            ) * con.quantity - con.unfixed_refund * 1000
+            cls.db.messages.add(
+                "contract_created",
+                con.fixed_holder,
+                con.contract_type,
+                cls.db.FIXED,
+                con.price,
+                con.quantity,
                 contract=con,
             )
-        if con.unfixed_refund:
-            self.db.messages.add(
-                "position_covered",
-                unfixed_holder,
-                contract_type,
-                quantity=con.unfixed_refund,
+            cls.db.messages.add(
+                "contract_created",
+                con.unfixed_holder,
+                con.contract_type,
+                cls.db.UNFIXED,
+                con.price,
+                con.quantity,
                 contract=con,
             )
+            if con.fixed_refund:
+                cls.db.messages.add(
+                    "position_covered",
+                    con.fixed_holder,
+                    con.contract_type,
+                    quantity=con.fixed_refund,
+                    contract=con,
+                )
+            if con.unfixed_refund:
+                cls.db.messages.add(
+                    "position_covered",
+                    con.unfixed_holder,
+                    con.contract_type,
+                    quantity=con.unfixed_refund,
+                    contract=con,
+                )
+        return balances
 
     def make_offer(
         self,
@@ -108,6 +123,7 @@ class Offer(object):
         quantity,
         all_or_nothing,
         expires=None,
+        quote=False,
     ):
         if side == self.db.UNFIXED:
             total = (1000 - price) * quantity
@@ -117,11 +133,23 @@ class Offer(object):
             "UPDATE account SET balance = balance - %s WHERE id = %s", (total, account)
         )
         curs.execute(
-            """INSERT INTO offer (account, contract_type, side, price, quantity, all_or_nothing, expires)
-            VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id""",
-            (account, contract_type.id, side, price, quantity, all_or_nothing, expires),
+            """INSERT INTO offer (account, contract_type, side, price, quantity, all_or_nothing, expires, quote)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id, created, expires,
+            (SELECT maturity.matures FROM maturity JOIN contract_type ON maturity.id = contract_type.matures
+                WHERE contract_type.id = offer.contract_type)""",
+            (
+                account,
+                contract_type.id,
+                side,
+                price,
+                quantity,
+                all_or_nothing,
+                expires,
+                quote,
+            ),
         )
-        self.id = curs.fetchone()[0]
+        (self.id, self.created, self.expires, matures) = curs.fetchone()
+        self.db.expiry.schedule(contract_type.id, self.expires, matures)
         self.db.messages.add(
             "offer_created", account, contract_type, side, price, quantity, offer=self
         )
@@ -137,6 +165,7 @@ class Offer(object):
         created=None,
         all_or_nothing=False,
         expires=None,
+        quote=False,
     ):
         assert price == int(price)
         assert price >= 1 and price <= 999
@@ -150,6 +179,7 @@ class Offer(object):
         self.created = created
         self.all_or_nothing = all_or_nothing
         self.expires = expires
+        self.quote = quote
         if not self.contract_type.id:
             raise NotImplementedError
 
@@ -212,11 +242,13 @@ class Offer(object):
     def filter(
         cls, oid=None, account=None, issue=None, include_private=False, db_cursor=None
     ):
-        "Look up offers. This can be called with or without a database cursor."
-        if db_cursor is None:  # Top level in this transaction
-            db_cursor = cls.db.conn.cursor()
-            cls._do_expire(db_cursor)  # remove any expired offers before searching
-            with db_cursor as curs:
+        """
+        Look up offers.  Offers that have expired are left out, whether or not
+        they have been cancelled yet (see expiry.py).  This can be called with
+        or without a database cursor.
+        """
+        if db_cursor is None:
+            with cls.db.conn.cursor() as curs:
                 result = cls.filter(
                     oid=oid,
                     account=account,
@@ -224,7 +256,7 @@ class Offer(object):
                     include_private=include_private,
                     db_cursor=curs,
                 )
-                cls.db.messages.flush(curs)
+                # End the read, so that NOW() is current on the next one.
                 curs.connection.commit()
                 return result
         (all_ids, all_accounts, all_issues) = (False, False, False)
@@ -243,56 +275,60 @@ class Offer(object):
         result = []
         curs = db_cursor
         curs.execute(
-            """SELECT account,
-                        maturity, matures,
-                        contract_type, issue, url, title,
-                        side, price, quantity, id, created,
-                        all_or_nothing, expires
-                        FROM offer_overview WHERE
-                        (id = %s OR %s) AND
-                        (account = %s OR %s) AND
-                        (issue = %s OR %s)
-                        """,
+            """SELECT %s FROM offer_overview WHERE
+                        (id = %%s OR %%s) AND
+                        (account = %%s OR %%s) AND
+                        (issue = %%s OR %%s) AND
+                        (expires IS NULL OR expires > NOW())
+                        """
+            % cls.columns,
             (oid, all_ids, uid, all_accounts, iid, all_issues),
         )
         for row in curs.fetchall():
-            (
-                uid,
-                mid,
-                matures,
-                cid,
-                iid,
-                url,
-                title,
-                side,
-                price,
-                quantity,
-                oid,
-                created,
-                all_or_nothing,
-                expires,
-            ) = row
-            account = Account(uid=uid)
-            issue = Issue(url=url, iid=iid, title=title)
-            if (not include_private) and (not issue.is_public):
+            offer = cls.from_row(row)
+            if (not include_private) and (not offer.contract_type.issue.is_public):
                 continue
-            maturity = Maturity(matures, mid)
-            ctype = ContractType(issue, maturity, cid)
-            result.append(
-                cls(
-                    account,
-                    ctype,
-                    side,
-                    price,
-                    quantity,
-                    oid,
-                    created,
-                    all_or_nothing,
-                    expires,
-                )
-            )
+            result.append(offer)
         return result
 
+    # Columns of offer_overview that from_row expects.
+    columns = """account, maturity, matures, contract_type, issue, url, title,
+                 side, price, quantity, id, created, all_or_nothing, expires"""
+
+    @classmethod
+    def from_row(cls, row):
+        (
+            uid,
+            mid,
+            matures,
+            cid,
+            iid,
+            url,
+            title,
+            side,
+            price,
+            quantity,
+            oid,
+            created,
+            all_or_nothing,
+            expires,
+        ) = row
+        account = Account(uid=uid)
+        issue = Issue(url=url, iid=iid, title=title)
+        maturity = Maturity(matures, mid)
+        ctype = ContractType(issue, maturity, cid)
+        return cls(
+            account,
+            ctype,
+            side,
+            price,
+            quantity,
+            oid,
+            created,
+            all_or_nothing,
+            expires,
+        )
+
     @property
     def datetime(self):
         return self.created.strftime("%d %b %H:%M")
@@ -322,98 +358,176 @@ class Offer(object):
             return False
         return Offer.by_id(self.id) is not None
 
-    def place(self):
-        result = []
-        with self.db.conn.cursor() as curs:
-            if self.side == self.db.FIXED:
-                curs.execute(
-                    """SELECT id, account, price, quantity, all_or_nothing
-                                FROM offer WHERE (expires IS NULL OR expires > NOW()) AND contract_type = %s AND side = %s and price <= %s
-                                ORDER BY price, created""",
-                    (self.contract_type.id, self.db.UNFIXED, self.price),
+    def place(self, db_cursor=None):
+        """
+        Match this offer against the book, and put whatever is left of it on the
+        book.  This can be called with or without a database cursor.  Without
+        one, the transaction is committed and the resulting messages returned.
+        """
+        if db_cursor is None:  # Top level in this transaction
+            with self.db.conn.cursor() as curs:
+                try:
+                    self.place(db_cursor=curs)
+                    result = self.db.messages.flush(curs)
+                    self.db.books.commit(curs)
+                except Exception:
+                    self.db.messages.clear()
+                    self.db.books.abort(curs)
+                    raise
+            return result
+        curs = db_cursor
+        book = self.db.books.get(curs, self.contract_type.id)
+        if not book.auction:  # Otherwise the offer waits for the auction
+            self.fill(curs, book, self.match(curs, book))
+        if self.quantity:  # Not filled, put the rest on the book
+            self.make_offer(
+                curs,
+                self.account.id,
+                self.contract_type,
+                self.side,
+                self.price,
+                self.quantity,
+                self.all_or_nothing,
+                self.expires,
+                self.quote,
+            )
+            book.add(
+                BookEntry(
+                    self.id,
+                    self.account.id,
+                    self.side,
+                    self.price,
+                    self.quantity,
+                    self.all_or_nothing,
+                    self.created,
+                    self.expires,
                 )
-                for row in curs.fetchall():
-                    (i, a, p, q, aon) = row
-                    # Don't match existing all or nothing offers with a new smaller offer
-                    if aon and q > self.quantity:
-                        continue
-                    # Don't match a new offer to an existing smaller offer
-                    if self.all_or_nothing and q < self.quantity:
-                        continue
-                    if q <= self.quantity:
-                        csize = q
-                    else:
-                        csize = self.quantity
-                    self.reduce_offer(curs, i, csize)
-                    contract_price = (
-                        self.price
-                    )  # FIXME whoever gets an offer in first should get the best price (?)
-                    self.make_contract(
-                        curs,
-                        contract_type=self.contract_type,
-                        fixed_holder=self.account.id,
-                        unfixed_holder=a,
-                        price=contract_price,
-                        quantity=csize,
-                    )
-                    self.quantity = self.quantity - csize
-                    if self.quantity == 0:
-                        break
-                else:  # No matching items, just make the offer
-                    self.make_offer(
-                        curs,
-                        self.account.id,
-                        self.contract_type,
-                        self.side,
-                        self.price,
-                        self.quantity,
-                        self.all_or_nothing,
-                        self.expires,
-                    )
-            else:  # side is UNFIXED
-                curs.execute(
-                    """SELECT id, account, price, quantity, all_or_nothing
-                                FROM offer WHERE (expires IS NULL OR expires > NOW()) AND contract_type = %s AND side = %s and price >= %s
-                                ORDER BY price DESC, created""",
-                    (self.contract_type.id, self.db.FIXED, self.price),
+            )
+
+    def match(self, curs, book):
+        """
+        Work out which resting offers on the book this offer would match,
+        without changing any of them.  Returns a list of (entry, quantity)
+        fills, best price first.
+
+        An all or nothing offer is filled from as many resting offers as it
+        takes, best price first, or not at all.
+        """
+        fills = []
+        remaining = self.quantity
+        if self.all_or_nothing and self.crossing_quantity(curs) < remaining:
+            return fills  # Not enough on offer, so don't read the book
+        for entry in book.crossing(curs, self.side, self.price):
+            if entry.expired(book.now):
+                continue
+            # Don't match existing all or nothing offers with a new smaller offer
+            if entry.all_or_nothing and entry.quantity > remaining:
+                continue
+            csize = min(entry.quantity, remaining)
+            fills.append((entry, csize))
+            remaining -= csize
+            if remaining == 0:
+                break
+        if self.all_or_nothing and remaining:
+            return []
+        return fills
+
+    def crossing_quantity(self, curs):
+        """
+        Units on offer at prices this offer crosses, from the price levels in
+        book_level.  Some of them may not be able to match (expired, or all or
+        nothing and too big), so this is only an upper bound.
+        """
+        if self.side:  # FIXED matches UNFIXED at or below its price
+            condition = "price <= %s"
+        else:  # UNFIXED matches FIXED at or above its price
+            condition = "price >= %s"
+        curs.execute(
+            """SELECT COALESCE(SUM(quantity), 0) FROM book_level
+                        WHERE contract_type = %%s AND side = %%s AND %s"""
+            % condition,
+            (self.contract_type.id, not self.side, self.price),
+        )
+        return curs.fetchone()[0]
+
+    @classmethod
+    def take(cls, curs, book, fills):
+        """
+        Take filled units off resting offers, in two statements however many
+        there are, and return the tokens that were set aside for them to each
+        account.  fills is a list of (entry, quantity).
+        """
+        (removed, reduced) = ([], [])
+        balances = collections.Counter()
+        for (entry, csize) in fills:
+            if entry.all_or_nothing and csize < entry.quantity:
+                raise RuntimeError(
+                    "All or nothing offers cannot be reduced, only removed entirely"
                 )
-                for row in curs.fetchall():
-                    (i, a, p, q, aon) = row
-                    if aon and q > self.quantity:
-                        continue
-                    if self.all_or_nothing and q < self.quantity:
-                        continue
-                    if q <= self.quantity:
-                        csize = q
-                    else:
-                        csize = self.quantity
-                    self.reduce_offer(curs, i, csize)
-                    contract_price = self.price
-                    self.make_contract(
-                        curs,
-                        contract_type=self.contract_type,
-                        fixed_holder=a,
-                        unfixed_holder=self.account.id,
-                        price=contract_price,
-                        quantity=csize,
-                    )
-                    self.quantity = self.quantity - csize
-                    if self.quantity == 0:
-                        break
-                else:
-                    self.make_offer(
-                        curs,
-                        self.account.id,
-                        self.contract_type,
-                        self.side,
-                        self.price,
-                        self.quantity,
-                        self.all_or_nothing,
-                        self.expires,
-                    )
-            result = self.db.messages.flush(curs)
-            curs.connection.commit()
-        return result
+            if entry.side:  # FIXED
+                balances[entry.account] += entry.price * csize
+            else:  # UNFIXED
+                balances[entry.account] += (1000 - entry.price) * csize
+            if csize == entry.quantity:
+                removed.append((entry.id, csize))
+            else:
+                reduced.append((entry.id, csize))
+        # The quantities in the book must match the table, or something has
+        # changed the offers behind the book's back.
+        if removed:
+            psycopg2.extras.execute_values(
+                curs,
+                """DELETE FROM offer USING (VALUES %s) AS filled (id, quantity)
+                WHERE offer.id = filled.id AND offer.quantity = filled.quantity""",
+                removed,
+                page_size=len(removed),
+            )
+            if curs.rowcount != len(removed):
+                raise RuntimeError
+        if reduced:
+            psycopg2.extras.execute_values(
+                curs,
+                """UPDATE offer SET quantity = offer.quantity - filled.quantity
+                FROM (VALUES %s) AS filled (id, quantity)
+                WHERE offer.id = filled.id AND offer.quantity > filled.quantity""",
+                reduced,
+                page_size=len(reduced),
+            )
+            if curs.rowcount != len(reduced):
+                raise RuntimeError
+        for (entry, csize) in fills:
+            if entry.id in book.entries:
+                book.reduce(entry.id, csize)
+        return balances
+
+    def fill(self, curs, book, fills, balances=None):
+        """
+        Apply fills from match() in a few statements however many there are:
+        the resting offers are reduced or removed, the contracts persisted, and
+        each account's balance changed once by the total of its refunds and
+        payments, and any other changes passed in balances.  The end result is
+        the same as applying the fills one by one.
+        """
+        balances = collections.Counter(balances or {})
+        if not fills:
+            Account.add_balances(curs, balances)
+            return
+        balances.update(self.take(curs, book, fills))
+        contracts = []
+        for (entry, csize) in fills:
+            # FIXME whoever gets an offer in first should get the best price (?)
+            if self.side == self.db.FIXED:
+                (fixed_holder, unfixed_holder) = (self.account.id, entry.account)
+            else:
+                (fixed_holder, unfixed_holder) = (entry.account, self.account.id)
+            contracts.append(
+                Contract(
+                    self.contract_type, fixed_holder, unfixed_holder, self.price, csize
+                )
+            )
+            self.quantity -= csize
+        balances.update(self.make_contracts(curs, contracts))
+        Account.add_balances(curs, balances)
 
     def cancel(self, user=None):
         if user and user != self.account:
@@ -425,31 +539,187 @@ class Offer(object):
                 self.price,
                 self.quantity,
             )
-            self.reduce_offer(curs, self.id, None)
-            self.db.messages.add(
-                "offer_cancelled",
-                self.account.id,
-                contract_type=contract_type,
-                price=price,
-                quantity=quantity,
-                offer=self,
-            )
-            result = self.db.messages.flush(curs)
-            curs.connection.commit()
+            try:
+                book = self.db.books.get(curs, contract_type.id)
+                self.reduce_offer(curs, self.id, None)
+                book.remove(self.id)
+                self.db.messages.add(
+                    "offer_cancelled",
+                    self.account.id,
+                    contract_type=contract_type,
+                    price=price,
+                    quantity=quantity,
+                    offer=self,
+                )
+                result = self.db.messages.flush(curs)
+                self.db.books.commit(curs)
+            except Exception:
+                self.db.messages.clear()
+                self.db.books.abort(curs)
+                raise
             return result
 
+    def collateral(self, price=None, quantity=None):
+        "Tokens set aside for this offer, or for one like it at another price or quantity."
+        if price is None:
+            price = self.price
+        if quantity is None:
+            quantity = self.quantity
+        if self.side:  # FIXED
+            return price * quantity
+        return (1000 - price) * quantity
+
+    def amend(self, price=None, quantity=None, user=None, db_cursor=None):
+        """
+        Change the price and/or quantity of this offer in one transaction.
+        Only the difference in tokens set aside is taken or returned.  An
+        offer that only gets smaller keeps its place in the queue.  Any other
+        change puts it at the back of the queue at its new price, matching
+        anything it now crosses first.  This can be called with or without a
+        database cursor.  Without one, the transaction is committed and the
+        resulting messages returned.
+        """
+        if user and user != self.account:
+            logging.info("Failed attempt to amend offer %d by %s" % (self.id, user))
+            return []
+        if db_cursor is None:  # Top level in this transaction
+            with self.db.conn.cursor() as curs:
+                try:
+                    self.amend(price, quantity, db_cursor=curs)
+                    result = self.db.messages.flush(curs)
+                    self.db.books.commit(curs)
+                except Exception:
+                    self.db.messages.clear()
+                    self.db.books.abort(curs)
+                    raise
+            return result
+        curs = db_cursor
+        book = self.db.books.get(curs, self.contract_type.id)
+        curs.execute(
+            """SELECT account, side, price, quantity, all_or_nothing, expires,
+                        expires <= LOCALTIMESTAMP FROM offer WHERE id = %s""",
+            (self.id,),
+        )
+        if curs.rowcount != 1:
+            raise RuntimeError("Offer %s is no longer on the book" % self.id)
+        (
+            account,
+            side,
+            old_price,
+            old_quantity,
+            aon,
+            expires,
+            expired,
+        ) = curs.fetchone()
+        (self.all_or_nothing, self.expires) = (aon, expires)
+        if expired:
+            raise RuntimeError("Offer %s has expired" % self.id)
+        if price is None:
+            price = old_price
+        if quantity is None:
+            quantity = old_quantity
+        assert price == int(price)
+        assert price >= 1 and price <= 999
+        assert quantity == int(quantity) and quantity > 0
+        (self.side, self.price, self.quantity) = (side, old_price, old_quantity)
+        old_collateral = self.collateral()
+        if price == old_price and quantity <= old_quantity:
+            # Smaller, or no change: keep the offer's place in the queue.
+            curs.execute(
+                "UPDATE offer SET quantity = %s WHERE id = %s", (quantity, self.id)
+            )
+            if self.id in book.entries:
+                book.reduce(self.id, old_quantity - quantity)
+            self.quantity = quantity
+            Account.add_balances(curs, {account: old_collateral - self.collateral()})
+        else:
+            book.remove(self.id)
+            (self.price, self.quantity) = (price, quantity)
+            fills = []
+            if not book.auction:  # Otherwise the offer waits for the auction
+                fills = self.match(curs, book)
+            left = quantity - sum(csize for (entry, csize) in fills)
+            self.fill(
+                curs,
+                book,
+                fills,
+                balances={account: old_collateral - self.collateral(quantity=left)},
+            )
+            if not left:
+                # Filled in full.  The message says so, with nothing left.
+                curs.execute("DELETE FROM offer WHERE id = %s", (self.id,))
+            else:
+                curs.execute(
+                    """UPDATE offer SET price = %s, quantity = %s, created = NOW()
+                                WHERE id = %s RETURNING created""",
+                    (price, left, self.id),
+                )
+                self.created = curs.fetchone()[0]
+                book.add(
+                    BookEntry(
+                        self.id,
+                        account,
+                        side,
+                        price,
+                        left,
+                        self.all_or_nothing,
+                        self.created,
+                        self.expires,
+                    )
+                )
+        self.db.messages.add(
+            "offer_amended",
+            account,
+            self.contract_type,
+            side,
+            self.price,
+            self.quantity,
+            offer=self,
+        )
+
     @classmethod
-    def _do_expire(cls, curs, oids_to_expire=None):
-        if oids_to_expire is None:
-            oids_to_expire = []
+    def _remove(cls, curs, condition, args=(), text=None):
+        """
+        Cancel every offer that meets an SQL condition on offer_overview, in a
+        fixed number of statements: the offers are deleted together, and each
+        account refunded with one update.  The contract types are locked in
+        order first, so that this can't deadlock with matching.  Each owner
+        gets an offer_cancelled message, and an info message with text if
+        given.  Returns the offers.
+        """
         curs.execute(
-            "SELECT offer.id FROM offer WHERE expires IS NOT NULL AND expires <= NOW()"
+            """SELECT DISTINCT contract_type FROM offer_overview WHERE %s
+                        ORDER BY contract_type"""
+            % condition,
+            args,
         )
+        books = {}
         for row in curs.fetchall():
-            oids_to_expire.append(row[0])
-        for oid in oids_to_expire:
-            offer = cls.filter(oid=oid, db_cursor=curs)[0]
-            cls.reduce_offer(curs, oid, None)
+            books[row[0]] = cls.db.books.get(curs, row[0])
+        if not books:
+            return []
+        curs.execute(
+            """WITH gone AS (DELETE FROM offer WHERE id IN
+                            (SELECT id FROM offer_overview WHERE %s) RETURNING id)
+                        SELECT %s FROM offer_overview WHERE id IN (SELECT id FROM gone)
+                        ORDER BY id"""
+            % (condition, cls.columns),
+            args,
+        )
+        offers = [cls.from_row(row) for row in curs.fetchall()]
+        refunds = collections.Counter()
+        for offer in offers:
+            if offer.side:  # FIXED
+                refunds[offer.account.id] += offer.price * offer.quantity
+            else:  # UNFIXED
+                refunds[offer.account.id] += (1000 - offer.price) * offer.quantity
+            # An offer on a contract type that wasn't locked here was placed
+            # since; its book will see the new version and reload.
+            book = books.get(offer.contract_type.id)
+            if book is not None:
+                book.remove(offer.id)
+        Account.add_balances(curs, refunds)
+        for offer in offers:
             cls.db.messages.add(
                 "offer_cancelled",
                 offer.account.id,
@@ -459,35 +729,105 @@ class Offer(object):
                 quantity=offer.quantity,
                 offer=offer,
             )
-            cls.db.messages.add(
-                "info",
-                offer.account.id,
-                text="An offer from you has expired because its expiration or the maturity date of the contract is in the past.",
-            )
+            if text:
+                cls.db.messages.add("info", offer.account.id, text=text)
+        return offers
 
     @classmethod
-    def cleanup(cls, db, contract_types=[]):
+    def mass_cancel(
+        cls,
+        account=None,
+        contract_type=None,
+        issue=None,
+        maturity=None,
+        side=None,
+        quote=None,
+        text=None,
+        db_cursor=None,
+    ):
         """
-        Remove any offers on contract types with a maturity date in the past.
-        Refund and send a message to the user who placed the offer.
-        This only needs to run after maturity dates have passed.
+        Cancel every offer that matches any combination of account, contract
+        type, issue, maturity, side and whether it is part of a quote (at
+        least one of them), however many there are, in a fixed number of
+        statements.  Each owner is told why with an info message if text is
+        given.  This can be called with or without a database cursor.  Without
+        one, the transaction is committed and the resulting messages returned.
         """
-        expired = []
+        if db_cursor is None:  # Top level in this transaction
+            with cls.db.conn.cursor() as curs:
+                try:
+                    cls.mass_cancel(
+                        account,
+                        contract_type,
+                        issue,
+                        maturity,
+                        side,
+                        quote,
+                        text,
+                        db_cursor=curs,
+                    )
+                    result = cls.db.messages.flush(curs)
+                    cls.db.books.commit(curs)
+                except Exception:
+                    cls.db.messages.clear()
+                    cls.db.books.abort(curs)
+                    raise
+            return result
+        (conditions, args) = ([], [])
+        for (column, value) in (
+            ("account", account),
+            ("contract_type", contract_type),
+            ("issue", issue),
+            ("maturity", maturity),
+        ):
+            if value is not None:
+                conditions.append("%s = %%s" % column)
+                args.append(value.id)
+        for (column, value) in (("side", side), ("quote", quote)):
+            if value is not None:
+                conditions.append("%s = %%s" % column)
+                args.append(value)
+        if not conditions:
+            raise ValueError("Say which offers to cancel")
+        return cls._remove(db_cursor, " AND ".join(conditions), tuple(args), text=text)
+
+    expired_text = "An offer from you has expired because its expiration or the maturity date of the contract is in the past."
 
-        for ctype in contract_types:
-            todo = cls.filter(issue=ctype.issue)
-            for item in todo:
-                if item.contract_type == ctype:
-                    expired.append(item.id)
+    @classmethod
+    def expire(cls, curs, cid=None):
+        """
+        Cancel offers that have expired or whose contract type has matured,
+        on one contract type or on all of them.
+        """
+        due = "(expires <= NOW() OR matures <= NOW())"
+        if cid is None:
+            return cls._remove(curs, due, text=cls.expired_text)
+        return cls._remove(
+            curs, "contract_type = %s AND " + due, (cid,), text=cls.expired_text
+        )
 
+    @classmethod
+    def cleanup(cls, db, contract_types=[]):
+        """
+        Remove any offers on contract types with a maturity date in the past,
+        any offers that have expired, and all offers on the given contract
+        types.  Refund and send a message to the user who placed the offer.
+        """
+        cids = [ctype.id for ctype in contract_types]
         with db.conn.cursor() as curs:
-            curs.execute(
-                """SELECT offer.id FROM offer JOIN contract_type ON offer.contract_type = contract_type.id
-                            JOIN maturity on contract_type.matures = maturity.id
-                            WHERE maturity.matures <= NOW()"""
-            )
-            for row in curs.fetchall():
-                expired.append(row[0])
-            cls._do_expire(curs, expired)
-            db.messages.flush(curs)
-        curs.connection.commit()
+            try:
+                cls._remove(
+                    curs,
+                    "(expires <= NOW() OR matures <= NOW() OR contract_type = ANY(%s))",
+                    (cids,),
+                    text=cls.expired_text,
+                )
+                db.messages.flush(curs)
+                db.books.commit(curs)
+            except Exception:
+                db.messages.clear()
+                db.books.abort(curs)
+                raise
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Replay real order flow through the matching engine, so that changes to
+# matching can be measured against what the market actually sees.
+#
+# The message log records what happened to offers, not the offers that came
+# in, so the order flow has to be pieced back together from it (see Flow).
+# Export it to a JSONL file of events, then replay that into a scratch
+# database:
+#
+#   replay.py export [--since=2024-01-01] > flow.jsonl
+#   DB_NAME=scratch replay.py run flow.jsonl
+#
+# The replay makes its own accounts and contract types, one for each in the
+# log, and reports orders per second, match latency, and whether the offers
+# left on the book at the end are the ones that the log says are there.
+
+import argparse
+import collections
+import datetime
+import json
+import sys
+import uuid
+
+from account import Account
+from book import OrderBook
+from issue import Issue
+from maturity import Maturity
+from timing import Timings
+
+LOG_CLASSES = ["offer_created", "offer_cancelled", "contract_created"]
+
+
+def read_log(db, since=None):
+    "The messages that the order flow is pieced together from, oldest first."
+    (where, args) = ("class::text = ANY(%s)", [LOG_CLASSES])
+    if since is not None:
+        where += " AND created >= %s"
+        args.append(since)
+    with db.conn.cursor() as curs:
+        curs.execute(
+            """SELECT id, class, created, recipient, contract_type, side, price, quantity
+                        FROM message WHERE %s ORDER BY id"""
+            % where,
+            args,
+        )
+        rows = curs.fetchall()
+        curs.connection.commit()
+        return rows
+
+
+class Flow(object):
+    """
+    Order flow pieced together from the message log.  Every message from one
+    transaction has the same created time, so the messages are taken a
+    transaction at a time:
+
+    - An offer_created message is an offer that went on the book, after
+      forming any contracts just before it at its price.
+    - Contracts with no offer_created after them are offers filled in full.
+      The contract price is the price of the incoming offer, and the other
+      side of each contract is an offer that was already on the book and
+      crosses that price, which tells the two sides apart.
+    - An offer_cancelled message cancels the resting offer from that account
+      with that price and quantity.
+
+    A log that starts part way through, or has offers amended, can have
+    fills and cancellations that don't match anything on the book; these are
+    counted in skipped.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.resting = collections.defaultdict(list)  # (account, cid, side): offers
+        self.skipped = 0
+
+    def transaction(self, rows):
+        pairs = []
+        for (mid, mclass, created, recipient, cid, side, price, quantity) in rows:
+            if mclass == "contract_created":
+                if side:  # FIXED holder, always added first
+                    pairs.append(
+                        {True: recipient, "price": price, "quantity": quantity}
+                    )
+                elif pairs and False not in pairs[-1]:
+                    pairs[-1][False] = recipient
+            elif mclass == "offer_created":
+                self.filled(cid, pairs, (recipient, side, price, quantity))
+                pairs = []
+            elif mclass == "offer_cancelled":
+                self.filled(cid, pairs)
+                pairs = []
+                self.cancel(recipient, cid, side, price, quantity)
+        if rows:
+            self.filled(rows[-1][4], pairs)
+
+    def filled(self, cid, pairs, offer=None):
+        """
+        Account for the contracts formed in a transaction, and the offer that
+        went on the book after them, if any.
+        """
+        pairs = [pair for pair in pairs if False in pair]
+        if offer is not None:
+            (account, side, price, quantity) = offer
+            start = len(pairs)
+            while (
+                start
+                and pairs[start - 1][side] == account
+                and pairs[start - 1]["price"] == price
+            ):
+                start -= 1
+            (pairs, run) = (pairs[:start], pairs[start:])
+        while pairs:
+            first = pairs[0]
+            incoming = self.incoming(cid, first)
+            length = 1
+            while (
+                length < len(pairs)
+                and pairs[length][incoming] == first[incoming]
+                and pairs[length]["price"] == first["price"]
+            ):
+                length += 1
+            self.placement(
+                cid, incoming, first[incoming], first["price"], pairs[:length]
+            )
+            pairs = pairs[length:]
+        if offer is not None:
+            self.placement(cid, side, account, price, run, quantity)
+
+    def incoming(self, cid, pair):
+        """
+        Which side of a contract was the incoming offer: the other side must
+        have had an offer resting on the book that crosses the contract price.
+        """
+        for side in (True, False):
+            resting = not side
+            if self.available(pair[resting], cid, resting, pair["price"]):
+                return side
+        return True
+
+    def crosses(self, side, price, limit):
+        return OrderBook.price_rank(side, price) <= OrderBook.price_rank(side, limit)
+
+    def available(self, account, cid, side, price):
+        return sum(
+            offer[2]
+            for offer in self.resting[(account, cid, side)]
+            if self.crosses(side, offer[1], price)
+        )
+
+    def placement(self, cid, side, account, price, fills, rest=0):
+        ref = len(self.events)
+        self.events.append(
+            {
+                "op": "place",
+                "ref": ref,
+                "account": account,
+                "contract_type": cid,
+                "side": side,
+                "price": price,
+                "quantity": rest + sum(pair["quantity"] for pair in fills),
+            }
+        )
+        for pair in fills:
+            self.take(pair[not side], cid, not side, pair["price"], pair["quantity"])
+        if rest:
+            self.resting[(account, cid, side)].append([ref, price, rest])
+
+    def take(self, account, cid, side, price, quantity):
+        "Fill resting offers from one account, best price first, then oldest."
+        offers = self.resting[(account, cid, side)]
+        offers.sort(key=lambda offer: OrderBook.price_rank(side, offer[1]))
+        for offer in offers:
+            if not quantity:
+                break
+            if self.crosses(side, offer[1], price):
+                taken = min(quantity, offer[2])
+                offer[2] -= taken
+                quantity -= taken
+        offers[:] = [offer for offer in offers if offer[2]]
+        if quantity:
+            self.skipped += 1
+
+    def cancel(self, account, cid, side, price, quantity):
+        # A single cancellation doesn't record the side.
+        sides = (True, False) if side is None else (side,)
+        for side in sides:
+            offers = self.resting[(account, cid, side)]
+            for offer in offers:
+                if offer[1] == price and offer[2] == quantity:
+                    offers.remove(offer)
+                    self.events.append({"op": "cancel", "ref": offer[0]})
+                    return
+        self.skipped += 1
+
+    def export(self):
+        """
+        The events, followed by one that says which offers should be left on
+        the book at the end.
+        """
+        offers = []
+        for ((account, cid, side), resting) in self.resting.items():
+            for (ref, price, quantity) in resting:
+                offers.append([account, cid, side, price, quantity])
+        return self.events + [
+            {"op": "expect", "offers": sorted(offers), "skipped": self.skipped}
+        ]
+
+
+def reconstruct(rows):
+    "Piece together the order flow from messages read with read_log."
+    flow = Flow()
+    transactions = collections.OrderedDict()
+    for row in rows:
+        transactions.setdefault((row[2], row[4]), []).append(row)
+    for rows in transactions.values():
+        flow.transaction(rows)
+    return flow
+
+
+def replay(db, events):
+    """
+    Place and cancel offers as the events say, with new accounts and
+    contract types standing in for the ones in the log.  Returns a report
+    with the timings, and whether the offers left on the book match.
+    """
+    timings = Timings()
+    maturity = Maturity(db.now() + datetime.timedelta(weeks=1)).persist(db)
+    (accounts, ctypes, offers) = ({}, {}, {})
+    (expected, missing) = (None, 0)
+    for event in events:
+        if event["op"] == "place":
+            account = accounts.get(event["account"])
+            if account is None:
+                account = Account(balance=10**15).persist(db)
+                accounts[event["account"]] = account
+            ctype = ctypes.get(event["contract_type"])
+            if ctype is None:
+                issue = Issue(
+                    url="https://replay.example.com/%s/%s"
+                    % (event["contract_type"], uuid.uuid4())
+                ).persist(db)
+                ctype = db.contract_type(issue, maturity).persist()
+                ctypes[event["contract_type"]] = ctype
+            offer = db.offer(
+                account, ctype, event["side"], event["price"], event["quantity"]
+            )
+            with timings.time("place"):
+                offer.place()
+            offers[event["ref"]] = offer
+        elif event["op"] == "cancel":
+            offer = offers.get(event["ref"])
+            found = []
+            if offer is not None and offer.id is not None:
+                found = db.offer.filter(oid=offer.id)
+            if not found:
+                missing += 1
+                continue
+            with timings.time("cancel"):
+                found[0].cancel()
+        elif event["op"] == "expect":
+            expected = event
+    account_ids = dict((a.id, old) for (old, a) in accounts.items())
+    ctype_ids = dict((c.id, old) for (old, c) in ctypes.items())
+    with db.conn.cursor() as curs:
+        curs.execute(
+            """SELECT account, contract_type, side, price, quantity FROM offer
+                        WHERE contract_type = ANY(%s)""",
+            (list(ctype_ids),),
+        )
+        left = sorted(
+            [account_ids[a], ctype_ids[cid], side, price, quantity]
+            for (a, cid, side, price, quantity) in curs.fetchall()
+        )
+        curs.connection.commit()
+    report = {
+        "events": len(events),
+        "timings": timings.summary(),
+        "missing": missing,
+        "offers_left": len(left),
+    }
+    if expected is not None:
+        report["offers_expected"] = len(expected["offers"])
+        report["skipped"] = expected["skipped"]
+        report["match"] = left == sorted(expected["offers"])
+    return report
+
+
+if __name__ == "__main__":
+    from market import Market
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--since")
+    parser.add_argument("command", choices=["export", "run"])
+    parser.add_argument("file", nargs="?")
+    args = parser.parse_args()
+    market = Market()
+    if args.command == "export":
+        for event in reconstruct(read_log(market, args.since)).export():
+            print(json.dumps(event))
+    else:
+        with open(args.file) if args.file else sys.stdin as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        print(json.dumps(replay(market, events), indent=2))
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
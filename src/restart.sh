@@ -20,6 +20,7 @@ pip3 install -r requirements.txt
 # Crontab entries
 chown root.root conf/cron/*/*
 chmod 755 conf/cron/*/*
+cp -p conf/cron/hourly/* /etc/cron.hourly
 cp -p conf/cron/daily/* /etc/cron.daily
 cp -p conf/cron/weekly/* /etc/cron.weekly
 
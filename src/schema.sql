@@ -103,8 +103,12 @@ CREATE TABLE IF NOT EXISTS contract_type (
 	id SERIAL PRIMARY KEY,
 	issue INT REFERENCES issue(id),
 	matures INT REFERENCES maturity(id),
+	book_version BIGINT NOT NULL DEFAULT 0, /* count of changes to offers, see bump_book_version */
+	auction BOOLEAN NOT NULL DEFAULT false, /* offers wait for a call auction, see auction.py */
         UNIQUE (issue, matures)
 );
+ALTER TABLE contract_type ADD COLUMN IF NOT EXISTS book_version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE contract_type ADD COLUMN IF NOT EXISTS auction BOOLEAN NOT NULL DEFAULT false;
 
 -- Open unmatched offers. We only track the quantity that is
 -- unmatched, not part of a contract
@@ -117,10 +121,85 @@ CREATE TABLE IF NOT EXISTS offer (
 	side BOOLEAN NOT NULL, /* true fixed false unfixed */
 	price BIGINT NOT NULL CHECK (price >= 0 AND price <= 1000), /* price of the "fixed" side in millitokens */
 	quantity BIGINT NOT NULL CHECK (quantity > 0), /* units, worth 1000 millitokens to the winner */
-	all_or_nothing BOOL NOT NULL DEFAULT false
+	all_or_nothing BOOL NOT NULL DEFAULT false,
+	quote BOOL NOT NULL DEFAULT false /* part of a market maker's two-sided quote */
 );
+ALTER TABLE offer ADD COLUMN IF NOT EXISTS quote BOOL NOT NULL DEFAULT false;
 DROP TRIGGER IF EXISTS check_offer_date ON offer;
 CREATE TRIGGER check_offer_date BEFORE INSERT ON offer FOR EACH ROW EXECUTE PROCEDURE check_contract_type_maturity();
+-- Order books are loaded a page at a time, best price first (see book.py).
+DROP INDEX IF EXISTS offer_contract_type;
+CREATE INDEX IF NOT EXISTS offer_book ON offer (contract_type, side, price, created, id);
+-- Offers that expire are cancelled when they come due (see expiry.py).
+CREATE INDEX IF NOT EXISTS offer_expires ON offer (contract_type, expires) WHERE expires IS NOT NULL;
+-- Quotes are replaced by account and contract type (see Market.quotes).
+CREATE INDEX IF NOT EXISTS offer_quote ON offer (account, contract_type) WHERE quote;
+
+-- Count every change to the offers on a contract type.  The application keeps
+-- order books in memory (see book.py) and uses this count to tell whether
+-- the offers have changed since it last looked.
+CREATE OR REPLACE FUNCTION bump_book_version()
+RETURNS TRIGGER AS $$
+BEGIN
+	IF TG_OP = 'DELETE' THEN
+		UPDATE contract_type SET book_version = book_version + 1 WHERE id = OLD.contract_type;
+		RETURN OLD;
+	END IF;
+	UPDATE contract_type SET book_version = book_version + 1 WHERE id = NEW.contract_type;
+	IF TG_OP = 'UPDATE' AND OLD.contract_type != NEW.contract_type THEN
+		UPDATE contract_type SET book_version = book_version + 1 WHERE id = OLD.contract_type;
+	END IF;
+	RETURN NEW;
+END;
+$$ language 'plpgsql';
+DROP TRIGGER IF EXISTS bump_offer_book_version ON offer;
+CREATE TRIGGER bump_offer_book_version AFTER INSERT OR UPDATE OR DELETE ON offer FOR EACH ROW EXECUTE PROCEDURE bump_book_version();
+
+-- The order book added up by price level, kept up to date by a trigger on
+-- offer, so that the depth of the book can be shown without reading every
+-- offer.  A level is removed when its last offer is.
+CREATE TABLE IF NOT EXISTS book_level (
+	contract_type INT REFERENCES contract_type(id) ON DELETE CASCADE,
+	side BOOLEAN NOT NULL,
+	price INT NOT NULL,
+	quantity BIGINT NOT NULL,     /* units on offer at this price */
+	orders INT NOT NULL,          /* number of offers */
+	aon_quantity BIGINT NOT NULL, /* units in all or nothing offers */
+	PRIMARY KEY (contract_type, side, price)
+);
+
+CREATE OR REPLACE FUNCTION update_book_level()
+RETURNS TRIGGER AS $$
+BEGIN
+	IF TG_OP = 'DELETE' OR TG_OP = 'UPDATE' THEN
+		UPDATE book_level SET quantity = quantity - OLD.quantity, orders = orders - 1,
+			aon_quantity = aon_quantity - CASE WHEN OLD.all_or_nothing THEN OLD.quantity ELSE 0 END
+			WHERE contract_type = OLD.contract_type AND side = OLD.side AND price = OLD.price;
+		DELETE FROM book_level WHERE contract_type = OLD.contract_type AND side = OLD.side
+			AND price = OLD.price AND orders <= 0;
+	END IF;
+	IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+		INSERT INTO book_level (contract_type, side, price, quantity, orders, aon_quantity)
+			VALUES (NEW.contract_type, NEW.side, NEW.price, NEW.quantity, 1,
+				CASE WHEN NEW.all_or_nothing THEN NEW.quantity ELSE 0 END)
+			ON CONFLICT (contract_type, side, price) DO UPDATE SET
+				quantity = book_level.quantity + EXCLUDED.quantity,
+				orders = book_level.orders + 1,
+				aon_quantity = book_level.aon_quantity + EXCLUDED.aon_quantity;
+	END IF;
+	RETURN NULL;
+END;
+$$ language 'plpgsql';
+DROP TRIGGER IF EXISTS update_offer_book_level ON offer;
+CREATE TRIGGER update_offer_book_level AFTER INSERT OR UPDATE OR DELETE ON offer FOR EACH ROW EXECUTE PROCEDURE update_book_level();
+
+-- Build the levels from scratch whenever the schema is applied, in case the
+-- offers were changed while the trigger was not there.
+DELETE FROM book_level;
+INSERT INTO book_level (contract_type, side, price, quantity, orders, aon_quantity)
+	SELECT contract_type, side, price, SUM(quantity), COUNT(*),
+	SUM(CASE WHEN all_or_nothing THEN quantity ELSE 0 END)
+	FROM offer GROUP BY contract_type, side, price;
 
 -- view on offers. Used in several related queries. Lets us select from this
 -- view at the application level since this is a view used often.
@@ -132,7 +211,8 @@ CREATE VIEW offer_overview AS
 	SELECT maturity.id AS maturity, maturity.matures,
 	contract_type.id AS contract_type,
 	issue.id AS issue, issue.url, issue.title,
-	offer.id, offer.account AS account, offer.side, offer.price, offer.quantity, offer.created, offer.all_or_nothing, offer.expires
+	offer.id, offer.account AS account, offer.side, offer.price, offer.quantity, offer.created, offer.all_or_nothing, offer.expires,
+	offer.quote
 	FROM maturity JOIN contract_type ON maturity.id = contract_type.matures
 	INNER JOIN issue ON issue.id = contract_type.issue
 	INNER JOIN offer ON contract_type.id = offer.contract_type;
@@ -163,17 +243,76 @@ CREATE TRIGGER check_position_date BEFORE INSERT ON position FOR EACH ROW EXECUT
 DROP TRIGGER IF EXISTS update_position_modified ON position;
 CREATE TRIGGER update_position_modified BEFORE UPDATE ON position FOR EACH ROW EXECUTE PROCEDURE update_modified_column();
 
+-- Contract types waiting to be resolved when they mature, and the side that
+-- wins as things stand: FIXED if the issue has been closed.  A contract type
+-- is queued when it is created, and the side follows the state of its issue
+-- from then on.  See Market.resolve_due.
+CREATE TABLE IF NOT EXISTS resolution (
+	contract_type INT PRIMARY KEY REFERENCES contract_type(id) ON DELETE CASCADE,
+	side BOOLEAN NOT NULL,
+	queued TIMESTAMP NOT NULL DEFAULT NOW() /* when the side last changed */
+);
+
+CREATE OR REPLACE FUNCTION queue_resolution()
+RETURNS TRIGGER AS $$
+BEGIN
+	IF TG_TABLE_NAME = 'contract_type' THEN
+		INSERT INTO resolution (contract_type, side)
+			SELECT NEW.id, NOT issue.open FROM issue WHERE issue.id = NEW.issue
+			ON CONFLICT (contract_type) DO NOTHING;
+	ELSE
+		UPDATE resolution SET side = NOT NEW.open, queued = NOW()
+			FROM contract_type WHERE contract_type.id = resolution.contract_type
+			AND contract_type.issue = NEW.id;
+	END IF;
+	RETURN NULL;
+END;
+$$ language 'plpgsql';
+DROP TRIGGER IF EXISTS queue_contract_type_resolution ON contract_type;
+CREATE TRIGGER queue_contract_type_resolution AFTER INSERT ON contract_type FOR EACH ROW EXECUTE PROCEDURE queue_resolution();
+DROP TRIGGER IF EXISTS queue_issue_resolution ON issue;
+CREATE TRIGGER queue_issue_resolution AFTER UPDATE OF open ON issue FOR EACH ROW
+	WHEN (OLD.open IS DISTINCT FROM NEW.open) EXECUTE PROCEDURE queue_resolution();
+
+-- Queue contract types from before the queue, unless they are done with.
+INSERT INTO resolution (contract_type, side)
+	SELECT contract_type.id, NOT issue.open
+	FROM contract_type JOIN issue ON issue.id = contract_type.issue
+	JOIN maturity ON maturity.id = contract_type.matures
+	WHERE maturity.matures > NOW()
+	OR EXISTS (SELECT 1 FROM position WHERE position.contract_type = contract_type.id)
+	ON CONFLICT (contract_type) DO NOTHING;
+
 -- messages
 -- message class enumerates the different kinds of messages.
 DO $$ BEGIN
 	CREATE TYPE message_class AS ENUM('system', 'info', 'offer_created', 'offer_cancelled',
 				          'contract_created', 'position_covered', 'contract_resolved',
-				          'new_account');
+				          'new_account', 'offer_amended');
 EXCEPTION
 	WHEN duplicate_object THEN null;
 END $$;
+ALTER TYPE message_class ADD VALUE IF NOT EXISTS 'offer_amended';
+-- The message table is partitioned by month of created, so that queries for
+-- recent messages only read recent months, and old months can be archived and
+-- dropped whole (see Message.archive). A message table from before
+-- partitioning is moved into the partitioned one.
+DO $$ BEGIN
+	IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'message' AND relkind = 'r') THEN
+		DROP VIEW IF EXISTS message_overview;
+		DROP VIEW IF EXISTS ticker;
+		ALTER TABLE message RENAME TO message_unpartitioned;
+		ALTER INDEX message_pkey RENAME TO message_unpartitioned_pkey;
+		DROP INDEX IF EXISTS message_created;
+		DROP INDEX IF EXISTS message_recipient;
+		DROP INDEX IF EXISTS message_newest;
+		DROP INDEX IF EXISTS message_recipient_newest;
+		ALTER SEQUENCE message_id_seq OWNED BY NONE;
+	END IF;
+END $$;
+CREATE SEQUENCE IF NOT EXISTS message_id_seq;
 CREATE TABLE IF NOT EXISTS message (
-	id SERIAL PRIMARY KEY,
+	id INT NOT NULL DEFAULT nextval('message_id_seq'),
 	class message_class NOT NULL,
 	created TIMESTAMP NOT NULL DEFAULT NOW(),
 	delivered TIMESTAMP, /* NULL: not delivered */
@@ -183,8 +322,54 @@ CREATE TABLE IF NOT EXISTS message (
 	price BIGINT,
 	quantity BIGINT,
 	expires TIMESTAMP DEFAULT NULL, /* NULL: never expires */
-	message TEXT NOT NULL
-);
+	message TEXT, /* free text, for the classes in Message.free_text; NULL for the rest */
+	PRIMARY KEY (id, created)
+) PARTITION BY RANGE (created);
+ALTER SEQUENCE message_id_seq OWNED BY message.id;
+-- Messages are read newest first, a page at a time, and in the order they
+-- were sent within a transaction (see Message.filter).
+DROP INDEX IF EXISTS message_created;
+DROP INDEX IF EXISTS message_recipient;
+CREATE INDEX IF NOT EXISTS message_newest ON message (created DESC, id);
+CREATE INDEX IF NOT EXISTS message_recipient_newest ON message (recipient, created DESC, id);
+-- For any message outside the months that have partitions.
+CREATE TABLE IF NOT EXISTS message_default PARTITION OF message DEFAULT;
+
+-- Make the partition for the month that starts on or before the given day,
+-- named message_YYYY_MM, taking any of its messages from the default partition.
+CREATE OR REPLACE FUNCTION create_message_partition(day DATE) RETURNS VOID AS $$
+DECLARE
+	start TIMESTAMP := date_trunc('month', day);
+	finish TIMESTAMP := date_trunc('month', day) + INTERVAL '1 month';
+	name TEXT := 'message_' || to_char(day, 'YYYY_MM');
+BEGIN
+	IF to_regclass(name) IS NOT NULL THEN
+		RETURN;
+	END IF;
+	EXECUTE format('CREATE TABLE %I (LIKE message INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', name);
+	EXECUTE format('INSERT INTO %I SELECT * FROM message_default WHERE created >= %L AND created < %L',
+		name, start, finish);
+	DELETE FROM message_default WHERE created >= start AND created < finish;
+	EXECUTE format('ALTER TABLE message ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+		name, start, finish);
+END;
+$$ language 'plpgsql';
+
+DO $$ BEGIN
+	IF to_regclass('message_unpartitioned') IS NOT NULL THEN
+		PERFORM create_message_partition(month::date) FROM generate_series(
+			(SELECT date_trunc('month', MIN(created)) FROM message_unpartitioned),
+			NOW(), INTERVAL '1 month') AS month;
+		INSERT INTO message (id, class, created, delivered, recipient, contract_type,
+			side, price, quantity, expires, message)
+			SELECT id, class, created, delivered, recipient, contract_type,
+			side, price, quantity, expires, message FROM message_unpartitioned;
+		DROP TABLE message_unpartitioned;
+	END IF;
+END $$;
+-- This month and the next few. Message.add_partitions keeps making them.
+SELECT create_message_partition(month::date) FROM generate_series(
+	date_trunc('month', NOW()), NOW() + INTERVAL '3 months', INTERVAL '1 month') AS month;
 
 -- For populating messages
 -- Note: table is actually persisted to the database. Tables are concepts that
@@ -201,17 +386,48 @@ CREATE VIEW message_overview AS
 	LEFT OUTER JOIN maturity ON maturity.id = contract_type.matures
 	LEFT OUTER JOIN issue ON issue.id = contract_type.issue;
 
+-- The trade tape: one row for every contract formed, at its (FIXED) price,
+-- and one for every contract type resolved, at 1000 if FIXED won or 0 if
+-- UNFIXED won, for all the units held. Only ever appended to.
+CREATE TABLE IF NOT EXISTS trade (
+	id SERIAL PRIMARY KEY,
+	class message_class NOT NULL, /* contract_created or contract_resolved */
+	contract_type INT NOT NULL REFERENCES contract_type(id),
+	side BOOLEAN NOT NULL DEFAULT true, /* prices are for the FIXED side */
+	price BIGINT NOT NULL,
+	quantity BIGINT NOT NULL,
+	created TIMESTAMP NOT NULL DEFAULT NOW()
+);
+DROP INDEX IF EXISTS trade_created;
+CREATE INDEX IF NOT EXISTS trade_newest ON trade (created DESC, id);
+CREATE INDEX IF NOT EXISTS trade_contract_type ON trade (contract_type, created, id);
+
+-- Trades from before the trade table, from the messages to FIXED holders.
+-- A resolution is counted from the messages to FIXED holders, so the units
+-- held are only approximate where fees were taken.
+DO $$ BEGIN
+	IF NOT EXISTS (SELECT 1 FROM trade) THEN
+		INSERT INTO trade (class, contract_type, side, price, quantity, created)
+			SELECT class, contract_type, true, price, quantity, created FROM message
+			WHERE class = 'contract_created' AND side AND contract_type IS NOT NULL
+			ORDER BY created, id;
+		INSERT INTO trade (class, contract_type, side, price, quantity, created)
+			SELECT 'contract_resolved', contract_type, true, MAX(price), SUM(quantity), MAX(created)
+			FROM message WHERE class = 'contract_resolved' AND side AND contract_type IS NOT NULL
+			GROUP BY contract_type ORDER BY MAX(created);
+	END IF;
+END $$;
+
 -- For summary stats
 DROP VIEW IF EXISTS ticker;
 CREATE VIEW ticker AS
-	SELECT DISTINCT maturity.id AS maturity, maturity.matures,
+	SELECT maturity.id AS maturity, maturity.matures,
 	contract_type.id AS contract_type,
 	issue.id AS issue, issue.url, issue.title,
-	message.id, message.class, message.side, message.price, message.quantity, message.expires, message.created
-	FROM maturity JOIN contract_type ON maturity.id = contract_type.matures
-	INNER JOIN issue ON issue.id = contract_type.issue
-	INNER JOIN message ON contract_type.id = message.contract_type
-	WHERE side IS NOT NULL AND price > 0;
+	trade.id, trade.class, trade.side, trade.price, trade.quantity, trade.created
+	FROM trade JOIN contract_type ON contract_type.id = trade.contract_type
+	JOIN maturity ON maturity.id = contract_type.matures
+	JOIN issue ON issue.id = contract_type.issue;
 
 -- create the system account if it does not exist
 INSERT INTO account (system, balance) SELECT true, 0
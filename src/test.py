@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
 from ast import Not
+import gzip
+import html
 from datetime import datetime, timedelta, timezone
 import logging
+import re
 import signal
 import sys
+import tempfile
+import threading
 import time
 import unittest
 import uuid
 
 try:
     import psycopg2
+    import psycopg2.errors
 except:
     print(
         "This should be run on the server or container with Python dependencies installed."
@@ -18,7 +24,11 @@ except:
     print("To start the container and run tests, use test.sh")
     sys.exit(0)
 
-from market import Market, Account, Issue, Maturity
+import bench
+from book import OrderBook
+import replay
+from market import Market, Account, Contract, Issue, Maturity
+from message import Message
 
 
 class BogusObject(object):
@@ -278,6 +288,8 @@ class MarketTestCase(unittest.TestCase):
         good_test_offer.place()
         found = testdb.offer.filter(account=testuser)
         self.assertEqual([], found)
+        testdb.expiry.run()
+        self.assertEqual(1000000, testuser.balance)
         messages = testdb.history.filter(account=testuser)
         cancellation = messages[0]
         self.assertIn("cancelled", cancellation.text)
@@ -1457,6 +1469,984 @@ class MarketTestCase(unittest.TestCase):
         user = market.lookup_user(host="local", sub=1004)
         self.assertEqual(10000, user.balance)
 
+    def test_order_book_reloads_after_change_elsewhere(self):
+        """
+        An order book kept in memory notices when another process has removed an offer,
+        and does not match against it.
+        """
+        other = Market()
+        testdb = Market()
+        testuser = Account(balance=9000).persist(testdb)
+        testfixer = Account(balance=1000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+
+        mlist = testdb.offer(
+            testuser, test_contract_type, Market.UNFIXED, 100, 10
+        ).place()
+        testdb.offer(testfixer, test_contract_type, Market.FIXED, 100, 1).place()
+        self.assertEqual(1, len(testdb.books.books[test_contract_type.id]))
+        with other.conn.cursor() as curs:
+            curs.execute("DELETE FROM offer WHERE id = %s", (mlist[0].offer.id,))
+            curs.connection.commit()
+
+        mlist = testdb.offer(
+            testfixer, test_contract_type, Market.FIXED, 100, 9
+        ).place()
+        self.assertEqual(1, len(mlist))
+        self.assertEqual("offer_created", mlist[0].mclass)
+
+    def test_order_book_loads_lazily(self):
+        "A small offer against a deep book only loads the best page of offers."
+        testdb = Market()
+        testuser = Account(balance=1000000).persist(testdb)
+        testfixer = Account(balance=1000).persist(testdb)
+        bigfixer = Account(balance=1000000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        orders = []
+        for price in range(100, 400):
+            orders.append(
+                {
+                    "issue": test_contract_type.issue.id,
+                    "maturity": test_contract_type.maturity.id,
+                    "side": Market.UNFIXED,
+                    "price": price,
+                    "quantity": 1,
+                }
+            )
+        testdb.place_orders(testuser, orders)
+        testdb.books.books.clear()
+
+        mlist = testdb.offer(
+            testfixer, test_contract_type, Market.FIXED, 500, 1
+        ).place()
+        self.assertEqual(2, len(mlist))
+        book = testdb.books.books[test_contract_type.id]
+        self.assertEqual(OrderBook.page_size - 1, len(book))
+
+        # Deeper matches keep loading as they go.
+        mlist = testdb.offer(
+            bigfixer, test_contract_type, Market.FIXED, 500, 299
+        ).place()
+        self.assertEqual(299 * 2, len(mlist))
+        self.assertEqual(0, len(book))
+        self.assertEqual([], testdb.offer.filter(account=testuser))
+
+    def test_place_orders_ladder(self):
+        "A ladder of offers is placed in one transaction, with results for each offer."
+        testdb = Market()
+        testuser = Account(balance=100000).persist(testdb)
+        testfixer = Account(balance=1000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        iid = test_contract_type.issue.id
+        mid = test_contract_type.maturity.id
+
+        testdb.offer(testfixer, test_contract_type, Market.FIXED, 100, 10).place()
+        ladder = []
+        for price in (100, 200, 300, 400, 500):
+            ladder.append(
+                {
+                    "issue": iid,
+                    "maturity": mid,
+                    "side": Market.UNFIXED,
+                    "price": price,
+                    "quantity": 10,
+                }
+            )
+        results = testdb.place_orders(testuser, ladder)
+        self.assertEqual(5, len(results))
+        # The lowest offer on the ladder is matched by the fixer's offer, the rest are placed.
+        self.assertEqual("contract_created", results[0][0].mclass)
+        for res in results[1:]:
+            self.assertEqual(1, len(res))
+            self.assertEqual("offer_created", res[0].mclass)
+        self.assertEqual(4, len(testdb.offer.filter(account=testuser)))
+        self.assertEqual(100000 - 9000 - 8000 - 7000 - 6000 - 5000, testuser.balance)
+
+    def test_place_orders_all_or_none(self):
+        "If one order in a batch fails, none of the orders are placed."
+        testdb = Market()
+        testuser = Account(balance=10000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        order = {
+            "issue": test_contract_type.issue.id,
+            "maturity": test_contract_type.maturity.id,
+            "side": Market.FIXED,
+            "price": 500,
+            "quantity": 10,
+        }
+        big_order = dict(order, quantity=1000)
+        with self.assertRaises(psycopg2.errors.CheckViolation):
+            testdb.place_orders(testuser, [order, big_order])
+        self.assertEqual([], testdb.offer.filter(account=testuser))
+        self.assertEqual(10000, testuser.balance)
+
+    def test_lookup_many_does_not_lock(self):
+        """
+        Looking up the contract types for a batch leaves them unlocked, so that
+        the batch can lock their books in id order like everything else.
+        """
+        testdb = Market()
+        other = Market()
+        first = self.make_contract_type(testdb)
+        second = self.make_contract_type(testdb)
+        pairs = [
+            (second.issue.id, second.maturity.id),
+            (first.issue.id, first.maturity.id),
+            (first.issue.id, second.maturity.id),
+        ]
+        with testdb.conn.cursor() as curs:
+            found = testdb.contract_type.lookup_many(pairs, curs)
+            with other.conn.cursor() as ocurs:
+                ocurs.execute(
+                    "SELECT id FROM contract_type WHERE id = ANY(%s) FOR UPDATE NOWAIT",
+                    ([first.id, second.id],),
+                )
+                self.assertEqual(2, ocurs.rowcount)
+                ocurs.connection.rollback()
+            curs.connection.rollback()
+        self.assertEqual(set(pairs), set(found))
+        self.assertEqual(first.id, found[pairs[1]].id)
+        self.assertEqual(second.id, found[pairs[0]].id)
+
+    def test_concurrent_matching(self):
+        """
+        Fixers in several threads match the same user offer at once.  Each thread has its
+        own database connection, and the user's offer is never filled more than once.
+        """
+        testdb = Market()
+        testuser = Account(balance=18000).persist(testdb)
+        fixers = [Account(balance=1000).persist(testdb) for i in range(4)]
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(testuser, test_contract_type, Market.UNFIXED, 100, 20).place()
+
+        errors = []
+
+        def fix(fixer):
+            try:
+                for i in range(10):
+                    testdb.offer(
+                        fixer, test_contract_type, Market.FIXED, 100, 1
+                    ).place()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                testdb.disconnect()
+
+        threads = [threading.Thread(target=fix, args=(fixer,)) for fixer in fixers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+        user_position = testdb.position.filter(account=testuser)[0]
+        self.assertEqual(-20, user_position.quantity)
+        self.assertEqual([], testdb.offer.filter(account=testuser))
+        fixer_offers = testdb.offer.filter(issue=test_contract_type.issue)
+        self.assertEqual(20, sum(offer.quantity for offer in fixer_offers))
+        self.assertEqual(0, sum(fixer.balance for fixer in fixers))
+
+    def test_sweep_offsets_then_opens(self):
+        """
+        A FIXED offer that sweeps two resting UNFIXED offers first covers the user's
+        UNFIXED position, then opens a new FIXED position with a fresh basis.
+        """
+        testdb = Market()
+        testuser = Account(balance=20000).persist(testdb)
+        (testfixer, seller_1, seller_2) = [
+            Account(balance=b).persist(testdb) for b in (1000, 5000, 5000)
+        ]
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(testfixer, test_contract_type, Market.FIXED, 100, 10).place()
+        testdb.offer(testuser, test_contract_type, Market.UNFIXED, 100, 10).place()
+        self.assertEqual(11000, testuser.balance)
+        for seller in (seller_1, seller_2):
+            testdb.offer(seller, test_contract_type, Market.UNFIXED, 500, 10).place()
+
+        mlist = testdb.offer(
+            testuser, test_contract_type, Market.FIXED, 500, 20
+        ).place()
+        self.assertEqual(
+            [
+                ("contract_created", testuser.id),
+                ("contract_created", seller_1.id),
+                ("position_covered", testuser.id),
+                ("contract_created", testuser.id),
+                ("contract_created", seller_2.id),
+            ],
+            [(m.mclass, m.account) for m in mlist],
+        )
+        self.assertEqual(11000, testuser.balance)
+        self.assertEqual(0, seller_1.balance)
+        self.assertEqual(0, seller_2.balance)
+        self.assertEqual([], testdb.offer.filter(issue=test_contract_type.issue))
+        user_position = testdb.position.filter(account=testuser)[0]
+        self.assertEqual((10, 5000), (user_position.quantity, user_position.basis))
+        for seller in (seller_1, seller_2):
+            position = testdb.position.filter(account=seller)[0]
+            self.assertEqual((-10, 5000), (position.quantity, position.basis))
+
+    def test_auction_clearing(self):
+        """
+        In auction mode offers wait on the book, then all match at once at the
+        price that matches the most units.
+        """
+        testdb = Market()
+        test_contract_type = self.make_contract_type(testdb).set_auction()
+        (fixer_a, fixer_b, user_c, user_d) = [
+            Account(balance=b).persist(testdb) for b in (6000, 5000, 6000, 5000)
+        ]
+        for (account, side, price) in (
+            (fixer_a, Market.FIXED, 600),
+            (fixer_b, Market.FIXED, 500),
+            (user_c, Market.UNFIXED, 400),
+            (user_d, Market.UNFIXED, 500),
+        ):
+            mlist = testdb.offer(account, test_contract_type, side, price, 10).place()
+            self.assertEqual(["offer_created"], [m.mclass for m in mlist])
+
+        self.assertIn(test_contract_type, testdb.contract_type.auctions())
+        mlist = testdb.clear_auctions()
+        mlist = [m for m in mlist if m.contract_type.id == test_contract_type.id]
+        self.assertEqual(4, len(mlist))
+        for message in mlist:
+            self.assertEqual(("contract_created", 500), (message.mclass, message.price))
+        self.assertEqual([], testdb.offer.filter(issue=test_contract_type.issue))
+        for account in (fixer_a, user_c):
+            self.assertEqual(1000, account.balance)
+        for account in (fixer_b, user_d):
+            self.assertEqual(0, account.balance)
+        self.assertEqual(10, testdb.position.filter(account=fixer_a)[0].quantity)
+        self.assertEqual(-10, testdb.position.filter(account=user_c)[0].quantity)
+
+    def test_auction_all_or_nothing(self):
+        "An all or nothing offer that doesn't fit at the clearing price stays on the book."
+        testdb = Market()
+        test_contract_type = self.make_contract_type(testdb).set_auction()
+        (fixer_a, fixer_b, user_c, user_d) = [
+            Account(balance=b).persist(testdb) for b in (6000, 5000, 6000, 7500)
+        ]
+        testdb.offer(fixer_a, test_contract_type, Market.FIXED, 600, 10).place()
+        testdb.offer(fixer_b, test_contract_type, Market.FIXED, 500, 10).place()
+        testdb.offer(user_c, test_contract_type, Market.UNFIXED, 400, 10).place()
+        testdb.offer(
+            user_d, test_contract_type, Market.UNFIXED, 500, 15, all_or_nothing=True
+        ).place()
+
+        mlist = test_contract_type.clear()
+        self.assertEqual(2, len(mlist))
+        self.assertEqual(500, mlist[0].price)
+        self.assertEqual(
+            [(fixer_a.id, Market.FIXED), (user_c.id, Market.UNFIXED)],
+            [(m.account, m.side) for m in mlist],
+        )
+        left = testdb.offer.filter(issue=test_contract_type.issue)
+        self.assertEqual(
+            [(fixer_b.id, 10), (user_d.id, 15)],
+            sorted((offer.account.id, offer.quantity) for offer in left),
+        )
+
+    def test_auction_switched_off(self):
+        "Offers that crossed while waiting for an auction match when auction mode goes off."
+        testdb = Market()
+        test_contract_type = self.make_contract_type(testdb).set_auction()
+        fixer = Account(balance=5000).persist(testdb)
+        user = Account(balance=5000).persist(testdb)
+        testdb.offer(fixer, test_contract_type, Market.FIXED, 500, 10).place()
+        testdb.offer(user, test_contract_type, Market.UNFIXED, 500, 10).place()
+        self.assertEqual(2, len(testdb.offer.filter(issue=test_contract_type.issue)))
+
+        test_contract_type.set_auction(False)
+        self.assertNotIn(test_contract_type, testdb.contract_type.auctions())
+        self.assertEqual([], testdb.offer.filter(issue=test_contract_type.issue))
+        self.assertEqual(10, testdb.position.filter(account=fixer)[0].quantity)
+        self.assertEqual(-10, testdb.position.filter(account=user)[0].quantity)
+        self.assertEqual(0, fixer.balance)
+        self.assertEqual(0, user.balance)
+
+    def test_depth(self):
+        "The depth of the book follows offers as they are placed, matched and cancelled."
+        testdb = Market()
+        testuser = Account(balance=100000).persist(testdb)
+        testfixer = Account(balance=10000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(testuser, test_contract_type, Market.UNFIXED, 100, 10).place()
+        testdb.offer(testuser, test_contract_type, Market.UNFIXED, 100, 5).place()
+        testdb.offer(
+            testuser, test_contract_type, Market.UNFIXED, 200, 20, all_or_nothing=True
+        ).place()
+        mlist = testdb.offer(testfixer, test_contract_type, Market.FIXED, 50, 7).place()
+
+        (book,) = testdb.depth(test_contract_type.issue)
+        self.assertEqual(test_contract_type.id, book["contract_type"])
+        self.assertEqual([(50, 7, 1, 0)], book[Market.FIXED])
+        self.assertEqual([(100, 15, 2, 0), (200, 20, 1, 20)], book[Market.UNFIXED])
+
+        testdb.offer(testfixer, test_contract_type, Market.FIXED, 100, 12).place()
+        mlist[0].offer.cancel()
+        (book,) = testdb.depth(test_contract_type.issue)
+        self.assertEqual([], book[Market.FIXED])
+        self.assertEqual([(100, 3, 1, 0), (200, 20, 1, 20)], book[Market.UNFIXED])
+
+    def test_expiry_scheduler(self):
+        "Offers are cancelled in bulk when they come due, not when they are read."
+        testdb = Market()
+        testuser = Account(balance=10000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        expires = datetime.now() + timedelta(seconds=1)
+        for price in (100, 200):
+            testdb.offer(
+                testuser, test_contract_type, Market.FIXED, price, 10, expires=expires
+            ).place()
+        self.assertEqual(7000, testuser.balance)
+        self.assertIn(test_contract_type.id, testdb.expiry.due)
+        testdb.expiry.run()
+        self.assertEqual(2, len(testdb.offer.filter(account=testuser)))
+
+        time.sleep(1)
+        self.assertEqual([], testdb.offer.filter(account=testuser))
+        self.assertEqual(7000, testuser.balance)  # reading doesn't cancel anything
+        mlist = testdb.expiry.run()
+        cancelled = [m for m in mlist if m.account == testuser.id]
+        self.assertEqual(
+            ["offer_cancelled", "info", "offer_cancelled", "info"],
+            [m.mclass for m in cancelled],
+        )
+        self.assertEqual(10000, testuser.balance)
+        self.assertNotIn(test_contract_type.id, testdb.expiry.due)
+
+    def test_expiry_failure(self):
+        "One contract type that fails to expire doesn't hold up the others."
+        testdb = Market()
+        testuser = Account(balance=10000).persist(testdb)
+        (failing, working) = sorted(
+            (self.make_contract_type(testdb) for i in range(2)), key=lambda c: c.id
+        )
+        expires = datetime.now() + timedelta(seconds=1)
+        for ctype in (failing, working):
+            testdb.offer(
+                testuser, ctype, Market.FIXED, 100, 10, expires=expires
+            ).place()
+        time.sleep(1)
+
+        expire = testdb.expiry.expire
+
+        def expire_or_fail(cid):
+            if cid == failing.id:
+                raise RuntimeError("failed on purpose")
+            return expire(cid)
+
+        testdb.expiry.expire = expire_or_fail
+        try:
+            with self.assertLogs(level="ERROR"):
+                testdb.expiry.run()
+        finally:
+            del testdb.expiry.expire
+        self.assertEqual(9000, testuser.balance)
+        self.assertIn(failing.id, testdb.expiry.due)
+        testdb.expiry.run()
+        self.assertEqual(10000, testuser.balance)
+
+    def test_mass_cancel(self):
+        "Offers are cancelled by account, issue and side, with one refund per account."
+        testdb = Market()
+        testuser = Account(balance=100000).persist(testdb)
+        otheruser = Account(balance=100000).persist(testdb)
+        ctype_1 = self.make_contract_type(testdb)
+        ctype_2 = self.make_contract_type(testdb)
+        for ctype in (ctype_1, ctype_2):
+            for (side, price) in ((Market.FIXED, 100), (Market.UNFIXED, 200)):
+                for account in (testuser, otheruser):
+                    testdb.offer(account, ctype, side, price, 10).place()
+        self.assertEqual(82000, testuser.balance)
+
+        mlist = testdb.cancel_offers(testuser, issue=ctype_1.issue, side=Market.UNFIXED)
+        self.assertEqual(["offer_cancelled"], [m.mclass for m in mlist])
+        self.assertEqual(ctype_1.id, mlist[0].contract_type.id)
+        self.assertEqual(90000, testuser.balance)
+
+        mlist = testdb.cancel_offers(testuser)
+        self.assertEqual(3, len(mlist))
+        self.assertEqual([], testdb.offer.filter(account=testuser))
+        self.assertEqual(100000, testuser.balance)
+        self.assertEqual(4, len(testdb.offer.filter(account=otheruser)))
+        with self.assertRaises(ValueError):
+            testdb.offer.mass_cancel()
+
+    def test_amend_keeps_queue_position(self):
+        "An offer that only gets smaller keeps its place, and gets the difference back."
+        testdb = Market()
+        (first, second) = [Account(balance=9000).persist(testdb) for i in range(2)]
+        testfixer = Account(balance=500).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        mlist = testdb.offer(first, test_contract_type, Market.UNFIXED, 100, 10).place()
+        testdb.offer(second, test_contract_type, Market.UNFIXED, 100, 10).place()
+
+        mlist = testdb.amend_offer(first, mlist[0].offer.id, quantity=5)
+        self.assertEqual(["offer_amended"], [m.mclass for m in mlist])
+        self.assertEqual(4500, first.balance)
+        mlist = testdb.offer(
+            testfixer, test_contract_type, Market.FIXED, 100, 5
+        ).place()
+        self.assertEqual(
+            [first.id, testfixer.id], sorted(m.account for m in mlist if m.account)
+        )
+        self.assertEqual([], testdb.offer.filter(account=first))
+        self.assertEqual(10, testdb.offer.filter(account=second)[0].quantity)
+
+    def test_amend_price_rematches(self):
+        "An offer moved to a price that crosses the book matches."
+        testdb = Market()
+        testuser = Account(balance=10000).persist(testdb)
+        testfixer = Account(balance=1000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(testfixer, test_contract_type, Market.FIXED, 100, 10).place()
+        mlist = testdb.offer(
+            testuser, test_contract_type, Market.UNFIXED, 300, 10
+        ).place()
+        self.assertEqual(3000, testuser.balance)
+
+        mlist = mlist[0].offer.amend(price=100, user=testuser)
+        self.assertEqual(
+            ["contract_created", "contract_created", "offer_amended"],
+            [m.mclass for m in mlist],
+        )
+        self.assertEqual(0, mlist[-1].quantity)  # nothing left on the book
+        self.assertEqual(1000, testuser.balance)
+        self.assertEqual(0, testfixer.balance)
+        self.assertEqual([], testdb.offer.filter(issue=test_contract_type.issue))
+        self.assertEqual(-10, testdb.position.filter(account=testuser)[0].quantity)
+
+    def test_amend_waits_for_auction(self):
+        "An offer amended to cross the book during an auction doesn't trade."
+        testdb = Market()
+        testuser = Account(balance=10000).persist(testdb)
+        testfixer = Account(balance=1000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(testfixer, test_contract_type, Market.FIXED, 100, 10).place()
+        mlist = testdb.offer(
+            testuser, test_contract_type, Market.UNFIXED, 300, 10
+        ).place()
+        test_contract_type.set_auction(True)
+
+        mlist = mlist[0].offer.amend(price=100, user=testuser)
+        self.assertEqual(["offer_amended"], [m.mclass for m in mlist])
+        self.assertEqual(1000, testuser.balance)
+        self.assertEqual(2, len(testdb.offer.filter(issue=test_contract_type.issue)))
+        self.assertEqual([], testdb.position.filter(account=testuser))
+
+    def test_all_or_nothing_fills_from_many_offers(self):
+        "A big all or nothing offer fills from several smaller offers, best price first."
+        testdb = Market()
+        users = [Account(balance=10000).persist(testdb) for i in range(3)]
+        whale = Account(balance=15000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        for (user, price, quantity) in zip(users, (400, 450, 500), (10, 10, 15)):
+            testdb.offer(
+                user, test_contract_type, Market.UNFIXED, price, quantity
+            ).place()
+
+        mlist = testdb.offer(
+            whale, test_contract_type, Market.FIXED, 500, 30, all_or_nothing=True
+        ).place()
+        self.assertEqual(6, len(mlist))
+        self.assertEqual(
+            [10, 10, 10], [m.quantity for m in mlist if m.account == whale.id]
+        )
+        self.assertEqual(0, whale.balance)
+        self.assertEqual(30, testdb.position.filter(account=whale)[0].quantity)
+        (left,) = testdb.offer.filter(issue=test_contract_type.issue)
+        self.assertEqual((users[2].id, 5), (left.account.id, left.quantity))
+
+    def test_all_or_nothing_rests_when_not_enough(self):
+        "An all or nothing offer that can't be filled completely rests, changing nothing else."
+        testdb = Market()
+        users = [Account(balance=10000).persist(testdb) for i in range(2)]
+        whale = Account(balance=15000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        for user in users:
+            testdb.offer(user, test_contract_type, Market.UNFIXED, 500, 10).place()
+
+        mlist = testdb.offer(
+            whale, test_contract_type, Market.FIXED, 500, 30, all_or_nothing=True
+        ).place()
+        self.assertEqual(["offer_created"], [m.mclass for m in mlist])
+        self.assertEqual(0, whale.balance)
+        for user in users:
+            self.assertEqual(10, testdb.offer.filter(account=user)[0].quantity)
+        (book,) = testdb.depth(test_contract_type.issue)
+        self.assertEqual([(500, 30, 1, 30)], book[Market.FIXED])
+        self.assertEqual([(500, 20, 2, 0)], book[Market.UNFIXED])
+
+    def test_quote(self):
+        "A market maker's quote is replaced in one step, leaving other offers alone."
+        testdb = Market()
+        maker = Account(balance=100000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(maker, test_contract_type, Market.FIXED, 100, 1).place()
+
+        mlist = testdb.quote(maker, test_contract_type, 400, 600, 10)
+        self.assertEqual(["offer_created", "offer_created"], [m.mclass for m in mlist])
+        self.assertEqual(100000 - 100 - 4000 - 4000, maker.balance)
+        mlist = testdb.quote(maker, test_contract_type, 450, 550, 20)
+        self.assertEqual(
+            ["offer_cancelled"] * 2 + ["offer_created"] * 2, [m.mclass for m in mlist]
+        )
+        self.assertEqual(100000 - 100 - 9000 - 9000, maker.balance)
+        offers = testdb.offer.filter(account=maker)
+        self.assertEqual(
+            [(100, 1), (450, 20), (550, 20)],
+            sorted((offer.price, offer.quantity) for offer in offers),
+        )
+        with self.assertRaises(ValueError):
+            testdb.quote(maker, test_contract_type, 500, 500, 10)
+
+    def test_bulk_quotes(self):
+        "Quotes on many contract types are replaced together."
+        testdb = Market()
+        maker = Account(balance=100000).persist(testdb)
+        ctypes = [self.make_contract_type(testdb) for i in range(3)]
+        quotes = [
+            {
+                "issue": ctype.issue.id,
+                "maturity": ctype.maturity.id,
+                "bid": 300,
+                "ask": 700,
+                "size": 5,
+            }
+            for ctype in ctypes
+        ]
+        results = testdb.quotes(maker, quotes)
+        self.assertEqual([2, 2, 2], [len(res) for res in results])
+        self.assertNotIn(
+            "contract_type", quotes[0]
+        )  # the caller's quotes are left alone
+        quotes[0]["size"] = 0
+        results = testdb.quotes(maker, quotes)
+        self.assertEqual([2, 4, 4], [len(res) for res in results])
+        self.assertEqual(4, len(testdb.offer.filter(account=maker)))
+        self.assertEqual(100000 - 4 * 1500, maker.balance)
+
+    def test_replay(self):
+        "Order flow pieced together from the message log replays to the same book."
+        testdb = Market()
+        maker = Account(balance=100000).persist(testdb)
+        taker = Account(balance=100000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(maker, test_contract_type, Market.FIXED, 400, 10).place()
+        testdb.offer(taker, test_contract_type, Market.UNFIXED, 300, 4).place()
+        testdb.offer(taker, test_contract_type, Market.UNFIXED, 450, 3).place()
+        testdb.offer.filter(account=maker)[0].cancel()
+
+        rows = [
+            row for row in replay.read_log(testdb) if row[4] == test_contract_type.id
+        ]
+        events = replay.reconstruct(rows).export()
+        self.assertEqual(
+            [
+                ("place", maker.id, True, 400, 10),
+                ("place", taker.id, False, 300, 4),
+                ("place", taker.id, False, 450, 3),
+                ("cancel",),
+            ],
+            [
+                (e["op"], e["account"], e["side"], e["price"], e["quantity"])
+                if e["op"] == "place"
+                else (e["op"],)
+                for e in events[:-1]
+            ],
+        )
+        self.assertEqual(
+            [[taker.id, test_contract_type.id, False, 450, 3]], events[-1]["offers"]
+        )
+        report = replay.replay(testdb, events)
+        self.assertTrue(report["match"])
+        self.assertEqual(0, report["missing"])
+        self.assertEqual(3, report["timings"]["place"]["count"])
+
+    def test_bench(self):
+        "The benchmark runs at a small scale and times everything it says it does."
+        testdb = Market()
+        timings = bench.run(testdb, issues=3, orders=50, bots=5, resolve=2)
+        summary = timings.summary()
+        self.assertGreaterEqual(summary["Offer.place"]["count"], 50)
+        self.assertEqual(2, summary["ContractType.resolve"]["count"])
+        self.assertIn("p99_ms", summary["Offer.filter"])
+
+    def test_persist_all(self):
+        "Contracts are netted against old positions in turn, and written together."
+        testdb = Market()
+        user = Account(balance=100000).persist(testdb)
+        other = Account(balance=100000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        query = "SELECT account, quantity, basis FROM position WHERE contract_type = %s"
+        with testdb.conn.cursor() as curs:
+            first = Contract(test_contract_type, user.id, other.id, 300, 10)
+            second = Contract(test_contract_type, other.id, user.id, 400, 4)
+            Contract.persist_all(curs, [first, second])
+            self.assertEqual((0, 0), (first.fixed_refund, first.unfixed_refund))
+            self.assertEqual((4, 4), (second.fixed_refund, second.unfixed_refund))
+            curs.execute(query, (test_contract_type.id,))
+            self.assertEqual(
+                [
+                    (user.id, 6, 300 * 10 + 600 * 4 - 4000),
+                    (other.id, -6, 700 * 10 + 400 * 4 - 4000),
+                ],
+                sorted(curs.fetchall()),
+            )
+            third = Contract(test_contract_type, other.id, user.id, 500, 6)
+            Contract.persist_all(curs, [third])
+            self.assertEqual((6, 6), (third.fixed_refund, third.unfixed_refund))
+            curs.execute(query, (test_contract_type.id,))
+            self.assertEqual([], curs.fetchall())
+            curs.connection.rollback()
+
+    def test_resolve_many_holders(self):
+        "Resolution settles every holder together, and leaves other contract types alone."
+        testdb = Market()
+        fixers = [Account(balance=10000).persist(testdb) for i in range(3)]
+        taker = Account(balance=100000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        other_contract_type = self.make_contract_type(testdb)
+        for fixer in fixers:
+            testdb.offer(fixer, test_contract_type, Market.FIXED, 400, 10).place()
+        testdb.offer(taker, test_contract_type, Market.UNFIXED, 400, 30).place()
+        testdb.offer(taker, test_contract_type, Market.UNFIXED, 900, 5).place()
+        testdb.offer(taker, other_contract_type, Market.UNFIXED, 900, 5).place()
+        self.assertEqual(100000 - 18000 - 500 - 500, taker.balance)
+
+        msglist = test_contract_type.resolve(True)
+        # Each fixer's profit of 6 tokens pays an oracle fee of 1 token.
+        for fixer in fixers:
+            self.assertEqual(10000 - 4000 + 9000, fixer.balance)
+            self.assertEqual(
+                [("contract_resolved", 1000, 9)],
+                [
+                    (m.mclass, m.price, m.quantity)
+                    for m in msglist.filter(account=fixer)
+                ],
+            )
+        self.assertEqual(100000 - 18000 - 500, taker.balance)
+        taker_messages = msglist.filter(account=taker)
+        self.assertEqual(
+            ["offer_cancelled", "info", "contract_resolved"],
+            [m.mclass for m in taker_messages],
+        )
+        # The taker is told why the offer went.
+        self.assertEqual(testdb.offer.expired_text, str(taker_messages[1]))
+        self.assertEqual([], testdb.position.filter(account=taker))
+        self.assertEqual(1, len(testdb.offer.filter(account=taker)))
+        self.assertEqual([], testdb.offer.filter(issue=test_contract_type.issue))
+        # The resolved contract type stays, for the messages and trades on it.
+        with testdb.conn.cursor() as curs:
+            curs.execute(
+                "SELECT id FROM contract_type WHERE id = ANY(%s) ORDER BY id",
+                ([test_contract_type.id, other_contract_type.id],),
+            )
+            self.assertEqual(
+                [(test_contract_type.id,), (other_contract_type.id,)], curs.fetchall()
+            )
+            curs.connection.commit()
+
+    def test_resolve_all(self):
+        "Many contract types resolve together on a pool of workers."
+        testdb = Market()
+        fixer = Account(balance=100000).persist(testdb)
+        hater = Account(balance=100000).persist(testdb)
+        ctypes = [self.make_contract_type(testdb) for i in range(4)]
+        for ctype in ctypes:
+            testdb.offer(fixer, ctype, Market.FIXED, 500, 10).place()
+            testdb.offer(hater, ctype, Market.UNFIXED, 500, 10).place()
+        self.assertEqual(100000 - 4 * 5000, fixer.balance)
+
+        sides = [(ctype, i % 2 == 0) for (i, ctype) in enumerate(ctypes)]
+        (messages, failures) = testdb.resolve_all(sides, workers=3)
+        self.assertEqual([], failures)
+        self.assertEqual(
+            8, len([m for m in messages if m.mclass == "contract_resolved"])
+        )
+        # Each winner's profit of 5 tokens pays an oracle fee of 1 token.
+        self.assertEqual(100000 - 4 * 5000 + 2 * 9000, fixer.balance)
+        self.assertEqual(100000 - 4 * 5000 + 2 * 9000, hater.balance)
+        self.assertEqual([], testdb.position.filter(account=fixer))
+        with self.assertRaises(ValueError):
+            testdb.resolve_all([], retries=0)
+
+    def test_resolve_due(self):
+        "Contract types are resolved when they mature, as the state of the issue says."
+        testdb = Market()
+        fixer = Account(balance=10000).persist(testdb)
+        hater = Account(balance=10000).persist(testdb)
+        url = "http://bug.example.com/%s/" % uuid.uuid4()
+        testissue = Issue(url=url).persist(testdb)
+        soon = Maturity(testdb.now() + timedelta(seconds=2)).persist(testdb)
+        later = Maturity(testdb.now() + timedelta(weeks=1)).persist(testdb)
+        due_contract_type = testdb.contract_type(testissue, soon).persist()
+        later_contract_type = testdb.contract_type(testissue, later).persist()
+        for ctype in (due_contract_type, later_contract_type):
+            testdb.offer(fixer, ctype, Market.FIXED, 500, 10).place()
+            testdb.offer(hater, ctype, Market.UNFIXED, 500, 10).place()
+        Issue(url=url, is_open=False).persist(testdb)  # the fix is in
+        time.sleep(2.5)
+
+        (messages, failures) = testdb.resolve_due()
+        self.assertEqual([], failures)
+        self.assertEqual(10000 - 10000 + 9000, fixer.balance)
+        self.assertEqual(0, hater.balance)
+        self.assertEqual(
+            [later_contract_type.id],
+            [pos.contract_type.id for pos in testdb.position.filter(account=fixer)],
+        )
+        (messages, failures) = testdb.resolve_due()
+        self.assertEqual([], [m for m in messages if m.account == fixer.id])
+
+    def test_valuation(self):
+        "Positions are marked at the middle of the book, or at the last contract."
+        testdb = Market()
+        fixer = Account(balance=100000).persist(testdb)
+        hater = Account(balance=100000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(fixer, test_contract_type, Market.FIXED, 400, 10).place()
+        testdb.offer(hater, test_contract_type, Market.UNFIXED, 400, 10).place()
+
+        # No offers left, so the mark is the last contract, at the price paid.
+        worth = testdb.valuation()
+        self.assertEqual(
+            {"positions": 1, "units": 10, "basis": 4000, "value": 4000, "pnl": 0},
+            worth[fixer.id],
+        )
+        self.assertEqual(6000, worth[hater.id]["value"])
+
+        testdb.offer(fixer, test_contract_type, Market.FIXED, 500, 1).place()
+        testdb.offer(hater, test_contract_type, Market.UNFIXED, 700, 1).place()
+        worth = testdb.valuation(fixer)
+        self.assertEqual([fixer.id], list(worth))
+        self.assertEqual(6000, worth[fixer.id]["value"])
+        self.assertEqual(2000, worth[fixer.id]["pnl"])
+
+    def test_portfolio(self):
+        "An account's holdings are summed in one query, and the summary follows trading."
+        testdb = Market()
+        user = Account(balance=100000).persist(testdb)
+        other = Account(balance=100000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(user, test_contract_type, Market.FIXED, 400, 10).place()
+        testdb.offer(user, test_contract_type, Market.UNFIXED, 700, 5).place()
+        self.assertEqual(
+            {
+                "balance": 100000 - 4000 - 1500,
+                "fixed_collateral": 4000,
+                "unfixed_collateral": 1500,
+                "basis": 0,
+                "positions": 0,
+            },
+            user.portfolio,
+        )
+        self.assertEqual(100000, user.total)
+
+        testdb.offer(other, test_contract_type, Market.UNFIXED, 400, 4).place()
+        summary = user.portfolio
+        self.assertEqual(2400, summary["fixed_collateral"])
+        self.assertEqual(1600, summary["basis"])
+        self.assertEqual(1, summary["positions"])
+        self.assertEqual(100000 - 4000 - 1500, user.balance)
+
+    def test_portfolio_cache(self):
+        "Summaries are kept only during a request, until the request writes something."
+        testdb = Market()
+        user = Account(balance=100000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.cache_portfolios()
+        self.assertEqual(100000, user.balance)
+        with testdb.conn.cursor() as curs:
+            curs.execute("UPDATE account SET balance = 50000 WHERE id = %s", (user.id,))
+            curs.connection.commit()
+        self.assertEqual(100000, user.balance)
+        testdb.offer(user, test_contract_type, Market.FIXED, 400, 10).place()
+        self.assertEqual(46000, user.balance)
+        testdb.end_transaction()
+        with testdb.conn.cursor() as curs:
+            curs.execute("UPDATE account SET balance = 40000 WHERE id = %s", (user.id,))
+            curs.connection.commit()
+        self.assertEqual(40000, user.balance)
+
+    def test_flush_many_messages(self):
+        "Messages from one transaction are stored together, in order, with their ids."
+        testdb = Market()
+        user = Account(balance=10000).persist(testdb)
+        for i in range(5):
+            testdb.messages.add("info", user.id, text="Message %d" % i)
+        testdb.messages.add("system", text="For the system")
+        with testdb.conn.cursor() as curs:
+            mlist = testdb.messages.flush(curs)
+            curs.connection.commit()
+        ids = [m.id for m in mlist]
+        self.assertEqual(sorted(ids), ids)
+        self.assertEqual(6, len(set(ids)))
+        self.assertEqual(testdb.system_id, mlist[-1].account)
+        with testdb.conn.cursor() as curs:
+            curs.execute(
+                "SELECT message FROM message WHERE id = ANY(%s) ORDER BY id", (ids,)
+            )
+            self.assertEqual(
+                ["Message %d" % i for i in range(5)] + ["For the system"],
+                [row[0] for row in curs.fetchall()],
+            )
+            curs.connection.commit()
+
+    def test_message_pages(self):
+        "Messages come a page at a time, newest first, with no gaps or repeats."
+        testdb = Market()
+        user = Account(balance=10000).persist(testdb)
+        for i in range(7):
+            testdb.messages.add("info", user.id, text="Message %d" % i)
+            with testdb.conn.cursor() as curs:
+                testdb.messages.flush(curs)
+                curs.connection.commit()
+        everything = testdb.history.filter(account=user)
+        pages = [testdb.history.filter(account=user, limit=3)]
+        while len(pages[-1]) == 3:
+            pages.append(
+                testdb.history.filter(account=user, before=pages[-1][-1], limit=3)
+            )
+        self.assertEqual([3, 3, 1], [len(page) for page in pages])
+        self.assertEqual(
+            [m.id for m in everything], [m.id for page in pages for m in page]
+        )
+        self.assertEqual("Message 6", str(pages[0][0]))
+
+    def test_issue_page_older_messages(self):
+        "The link to older trades on an issue page shows the next page."
+        import webapp
+
+        testdb = webapp.market
+        client = webapp.app.test_client()
+        client.get("/agent/%d" % (uuid.uuid4().int % 1000000))
+        test_contract_type = self.make_contract_type(testdb)
+        buyer = Account(balance=100000).persist(testdb)
+        seller = Account(balance=100000).persist(testdb)
+        for price in (200, 700):
+            testdb.offer(seller, test_contract_type, Market.FIXED, price, 10).place()
+            testdb.offer(buyer, test_contract_type, Market.UNFIXED, price, 10).place()
+        page = "/issue/%d" % test_contract_type.issue.id
+        page_size = Message.page_size
+        Message.page_size = 1
+        try:
+            newest = client.get(page).get_data(as_text=True)
+            link = re.search(r'href="(\?before=[^"]*)">Older messages', newest)
+            older = client.get(page + html.unescape(link.group(1)))
+        finally:
+            Message.page_size = page_size
+        self.assertEqual(200, older.status_code)
+        self.assertIn("<td>0.700</td>", newest)
+        self.assertNotIn("<td>0.200</td>", newest)
+        self.assertIn("<td>0.200</td>", older.get_data(as_text=True))
+
+    def test_message_text_made_when_shown(self):
+        "Only free text is stored, and other messages read back with the same text."
+        testdb = Market()
+        user = Account(balance=10000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        placed = testdb.offer(user, test_contract_type, Market.FIXED, 400, 10).place()
+        testdb.messages.add("info", user.id, text="Free text")
+        with testdb.conn.cursor() as curs:
+            sent = testdb.messages.flush(curs)
+            curs.connection.commit()
+            curs.execute(
+                "SELECT message FROM message WHERE id = ANY(%s) ORDER BY id",
+                ([placed[0].id, sent[0].id],),
+            )
+            self.assertEqual([(None,), ("Free text",)], curs.fetchall())
+            curs.connection.commit()
+        loaded = testdb.history.filter(account=user, limit=2)
+        self.assertEqual(["Free text", str(placed[0])], [str(m) for m in loaded])
+        self.assertTrue(str(placed[0]).startswith("Offer made: 10 units of FIXED"))
+
+    def test_archive_messages(self):
+        """
+        A month of old messages is archived to a file and dropped from the
+        database, once no reader is in the way.
+        """
+        testdb = Market()
+        user = Account(balance=10000).persist(testdb)
+        with testdb.conn.cursor() as curs:
+            curs.execute(
+                """INSERT INTO message (class, created, recipient, message)
+                            VALUES ('info', '2001-01-15', %s, 'Old news') RETURNING id""",
+                (user.id,),
+            )
+            mid = curs.fetchone()[0]
+            curs.connection.commit()
+            testdb.history.alter_partitions(
+                curs, [("SELECT create_message_partition('2001-01-01')", None)]
+            )
+            self.assertIn(
+                ("message_2001_01", datetime(2001, 1, 1).date()),
+                testdb.history.partitions(curs),
+            )
+            curs.connection.commit()
+        (lock_timeout, lock_tries) = (Message.lock_timeout, Message.lock_tries)
+        reader = testdb.connect()
+        try:
+            # A transaction that has read messages holds up the archive,
+            # which gives up rather than wait.
+            (Message.lock_timeout, Message.lock_tries) = (100, 2)
+            with reader.cursor() as curs:
+                curs.execute("SELECT COUNT(*) FROM message WHERE id = %s", (mid,))
+            with tempfile.TemporaryDirectory() as directory:
+                with self.assertRaises(psycopg2.errors.LockNotAvailable):
+                    testdb.history.archive(datetime(2001, 2, 1).date(), directory)
+                reader.rollback()
+                paths = testdb.history.archive(datetime(2001, 2, 1).date(), directory)
+                self.assertEqual(1, len(paths))
+                self.assertTrue(paths[0].endswith("message_2001_01.csv.gz"))
+                with gzip.open(paths[0], "rt") as f:
+                    self.assertIn("Old news", f.read())
+        finally:
+            (Message.lock_timeout, Message.lock_tries) = (lock_timeout, lock_tries)
+            reader.close()
+        with testdb.conn.cursor() as curs:
+            curs.execute("SELECT id FROM message WHERE id = %s", (mid,))
+            self.assertIsNone(curs.fetchone())
+            self.assertNotIn(
+                "message_2001_01",
+                [name for (name, first) in testdb.history.partitions(curs)],
+            )
+            curs.connection.commit()
+
+    def test_trade_tape(self):
+        "Each contract and each resolution goes on the trade tape once."
+        testdb = Market()
+        fixer = Account(balance=10000).persist(testdb)
+        funder = Account(balance=10000).persist(testdb)
+        test_contract_type = self.make_contract_type(testdb)
+        testdb.offer(fixer, test_contract_type, Market.FIXED, 400, 10).place()
+        testdb.offer(funder, test_contract_type, Market.UNFIXED, 400, 10).place()
+        testdb.offer(fixer, test_contract_type, Market.FIXED, 500, 5).place()
+        testdb.offer(funder, test_contract_type, Market.UNFIXED, 500, 5).place()
+        test_contract_type.resolve(False)
+        with testdb.conn.cursor() as curs:
+            curs.execute(
+                """SELECT class, side, price, quantity FROM trade
+                            WHERE contract_type = %s ORDER BY id""",
+                (test_contract_type.id,),
+            )
+            self.assertEqual(
+                [
+                    ("contract_created", True, 400, 10),
+                    ("contract_created", True, 500, 5),
+                    ("contract_resolved", True, 0, 15),
+                ],
+                curs.fetchall(),
+            )
+            curs.connection.commit()
+        lines = [
+            line
+            for line in testdb.ticker_csv().splitlines()
+            if test_contract_type.issue.url in line
+        ]
+        self.assertEqual(3, len(lines))
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Latency measurement for the replay and benchmark tools.
+
+import collections
+import contextlib
+import math
+import time
+
+
+def percentile(samples, fraction):
+    "The nearest-rank percentile of a list of samples, or None if it is empty."
+    if not samples:
+        return None
+    samples = sorted(samples)
+    rank = max(1, math.ceil(fraction * len(samples)))
+    return samples[rank - 1]
+
+
+class Timings(object):
+    "How long each run of some named operations took."
+
+    def __init__(self):
+        self.samples = collections.defaultdict(list)  # name: seconds for each run
+
+    @contextlib.contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[name].append(time.perf_counter() - start)
+
+    def summary(self):
+        """
+        For each operation, the number of runs, runs per second, and the
+        median, 99th percentile and worst latency in milliseconds.
+        """
+        result = {}
+        for (name, samples) in sorted(self.samples.items()):
+            total = sum(samples)
+            result[name] = {
+                "count": len(samples),
+                "per_second": round(len(samples) / total, 1) if total else None,
+                "p50_ms": round(percentile(samples, 0.5) * 1000, 3),
+                "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+                "max_ms": round(max(samples) * 1000, 3),
+            }
+        return result
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# What positions are worth today. Each contract type gets a mark, a price for
+# the FIXED side in millitokens: the middle of the best offers on the book if
+# there are offers on both sides, otherwise the price of the last contract
+# formed. Positions are then valued at the marks all at once, as columns.
+
+import numpy as np
+
+
+def load(curs, account=None):
+    "Every position, or one account's, as columns of account, contract type, quantity and basis."
+    curs.execute(
+        """SELECT account, contract_type, quantity, basis FROM position
+                    WHERE account = %s OR %s""",
+        (account, account is None),
+    )
+    rows = curs.fetchall()
+    columns = np.array(rows, dtype=np.int64).reshape(len(rows), 4)
+    return {
+        "account": columns[:, 0],
+        "contract_type": columns[:, 1],
+        "quantity": columns[:, 2],
+        "basis": columns[:, 3],
+    }
+
+
+def marks(curs, cids):
+    """
+    The mark for each of the given contract types, in the same order, or NaN
+    for a contract type with no offers on one side and no contracts.
+    """
+    cids = [int(cid) for cid in cids]
+    result = dict.fromkeys(cids, np.nan)
+    curs.execute(
+        """SELECT DISTINCT ON (contract_type) contract_type, price FROM trade
+                    WHERE class = 'contract_created' AND contract_type = ANY(%s)
+                    ORDER BY contract_type, created DESC, id DESC""",
+        (cids,),
+    )
+    result.update(curs.fetchall())
+    curs.execute(
+        """SELECT contract_type, MAX(price) FILTER (WHERE side),
+                    MIN(price) FILTER (WHERE NOT side)
+                    FROM book_level WHERE contract_type = ANY(%s) GROUP BY contract_type""",
+        (cids,),
+    )
+    for (cid, bid, ask) in curs.fetchall():
+        if bid is not None and ask is not None:
+            result[cid] = (bid + ask) / 2
+    return np.array([result[cid] for cid in cids], dtype=np.float64)
+
+
+def value(curs, account=None):
+    """
+    Mark every position, or one account's, to market.  Returns a dict by
+    account id of the number of positions, the units held, what was paid
+    for them (basis), what they are worth at the marks (value) and the
+    difference (pnl), all in millitokens.  A position with no mark is valued
+    at its basis.
+    """
+    positions = load(curs, account)
+    (cids, ctype_index) = np.unique(positions["contract_type"], return_inverse=True)
+    mark = marks(curs, cids)[ctype_index]
+    quantity = positions["quantity"]
+    basis = positions["basis"].astype(np.float64)
+    # FIXED units are worth the mark, UNFIXED units the rest of the 1000.
+    worth = np.where(quantity > 0, quantity * mark, -quantity * (1000 - mark))
+    worth = np.where(np.isnan(worth), basis, worth)
+    (accounts, index) = np.unique(positions["account"], return_inverse=True)
+    totals = {
+        "positions": np.bincount(index, minlength=len(accounts)),
+        "units": np.bincount(index, np.abs(quantity), len(accounts)),
+        "basis": np.bincount(index, basis, len(accounts)),
+        "value": np.bincount(index, worth, len(accounts)),
+    }
+    totals["pnl"] = totals["value"] - totals["basis"]
+    result = {}
+    for (i, uid) in enumerate(accounts.tolist()):
+        result[uid] = dict(
+            (name, int(round(column[i]))) for (name, column) in totals.items()
+        )
+    return result
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -2,6 +2,7 @@
 # Starts off Flask which is our web framework.
 
 # Import standard python modules.
+import datetime
 from hashlib import sha1
 import hmac
 import logging
@@ -129,6 +130,24 @@ def get_user():
     return user
 
 
+@app.before_request
+def expire_offers():
+    "Cancel offers that have come due, every so often."
+    market.expiry.poll()
+
+
+@app.teardown_request
+def end_transaction(exception):
+    "Don't leave this thread's connection in a transaction between requests."
+    market.end_transaction()
+
+
+@app.before_request
+def cache_portfolios():
+    "Start each request with fresh balances, kept until it writes anything."
+    market.cache_portfolios()
+
+
 @app.route("/localuser")
 def localuser():
     if "development" != app.config.get("ENV"):
@@ -190,6 +209,28 @@ def timejump():
 
 # Here we are populating the homepage once the application starts up (all the
 # data you see once the platform is up and running).
+def page_of_messages(**kwargs):
+    """
+    One page of messages, starting after the message in the before and
+    created arguments of the request if there are any, and the last message
+    on the page to start the next page from, or None if this is the last.
+    """
+    try:
+        before = market.history(
+            None,
+            created=datetime.datetime.fromisoformat(request.args["created"]),
+            mid=int(request.args["before"]),
+        )
+    except (KeyError, ValueError):
+        before = None
+    limit = market.history.page_size
+    messages = market.history.filter(before=before, limit=limit, **kwargs)
+    more = None
+    if len(messages) == limit:
+        more = messages[-1]
+    return (messages, more)
+
+
 @app.route("/")
 def index():
     code = request.args.get("code")
@@ -211,7 +252,7 @@ def index():
             flash("test users funded!")
         return render_template("index.html", hidenav=True, user=user)
     else:
-        messages = market.history.filter(account=user, ticker=False)
+        (messages, more) = page_of_messages(account=user, ticker=False)
         contracts = market.position.filter(account=user)
         offers = market.offer.filter(account=user)
         for offer in offers:
@@ -221,12 +262,15 @@ def index():
             offer.match_button = match_button(user, offer, match_own)
         for contract in contracts:
             contract.offset_form = offset_form(contract)
+        worth = market.valuation(user).get(user.id)
         return render_template(
             "userinfo.html",
             user=user,
             contracts=contracts,
             offers=offers,
             messages=messages,
+            more=more,
+            worth=worth,
         )
 
 
@@ -289,15 +333,16 @@ def issue_page(iid):
         return redirect(url_for("issues"))
     user = get_user()
     dest_url = "/issue/" + str(iid)
-    if request.args:
+    if set(request.args) - {"before", "created"}:
         return redirect(dest_url)
     issue = market.issue_by_id(iid)
     if not issue:
         return redirect(url_for("issues"))
     if (not issue.is_public) and (not user.banker):
         return redirect(url_for("issues"))
-    messages = market.history.filter(issue=issue, ticker=True)
+    (messages, more) = page_of_messages(issue=issue, ticker=True)
     offers = market.offer.filter(issue=issue)
+    depth = market.depth(issue)
     contracts = market.position.filter(issue=issue, account=user)
     for offer in offers:
         offer.cancel_button = cancel_button(user, offer)
@@ -311,11 +356,49 @@ def issue_page(iid):
         user=user,
         issue=issue,
         offers=offers,
+        depth=depth,
         contracts=contracts,
         messages=messages,
+        more=more,
     )
 
 
+@app.route("/depth/<iid>", methods=["GET"])
+def depth(iid):
+    """
+    The order book for an issue added up by price level, as JSON, with
+    prices in tokens.  Each maturity has its FIXED and UNFIXED levels, best
+    price first.
+    """
+    try:
+        iid = int(iid)
+    except:
+        abort(404)
+    user = get_user()
+    issue = market.issue_by_id(iid)
+    if not issue:
+        abort(404)
+    if (not issue.is_public) and (not user.banker):
+        abort(404)
+    result = []
+    for book in market.depth(issue):
+        sides = {}
+        for (name, side) in (("FIXED", True), ("UNFIXED", False)):
+            sides[name] = [
+                {
+                    "price": price / 1000,
+                    "quantity": quantity,
+                    "orders": orders,
+                    "all_or_nothing_quantity": aon,
+                }
+                for (price, quantity, orders, aon) in book[side]
+            ]
+        result.append(
+            dict(sides, maturity=book["maturity"], matures=book["matures"].isoformat())
+        )
+    return {"issue": issue.id, "depth": result}
+
+
 @app.route("/fakeissue")
 def fakeissue():
     if "development" != app.config.get("ENV"):
@@ -362,6 +445,7 @@ def offer_page(iid):
         form.maturity.data = mid
 
     offers = market.offer.filter(issue=issue)
+    depth = market.depth(issue)
     for offer in offers:
         offer.cancel_button = cancel_button(user, offer)
     match_own = app.config.get("MATCH_OWN_OFFERS", False)
@@ -373,6 +457,7 @@ def offer_page(iid):
         issue=issue,
         form=form,
         offers=offers,
+        depth=depth,
         maturities=maturities,
     )
 
@@ -428,6 +513,78 @@ def offer():
     return redirect(dest_url)
 
 
+def order_from_json(item):
+    "Convert one order from a JSON request into the form used by Market.place_orders."
+    if item["side"] == "FIXED":
+        side = True
+    elif item["side"] == "UNFIXED":
+        side = False
+    else:
+        raise ValueError("side must be FIXED or UNFIXED")
+    return {
+        "issue": int(item["issue"]),
+        "maturity": int(item["maturity"]),
+        "side": side,
+        "price": int(round(float(item["price"]) * 1000)),
+        "quantity": int(item["quantity"]),
+        "all_or_nothing": bool(item.get("all_or_nothing", False)),
+    }
+
+
+@app.route("/orders", methods=["POST"])
+def orders():
+    """
+    Place a batch of offers in one transaction. The request body is JSON:
+    {"orders": [{"issue": 3, "maturity": 76, "side": "FIXED", "price": 0.25,
+    "quantity": 10}, ...]} with prices in tokens, as on the offer form.
+    The response has the resulting messages for each order.
+    """
+    user = get_user()
+    try:
+        orders = [order_from_json(item) for item in request.get_json()["orders"]]
+    except Exception as e:
+        app.logger.info("Bad batch order request: %s" % e)
+        return {"error": "Bad or missing orders"}, 400
+    try:
+        results = market.place_orders(user, orders)
+    except Exception as e:
+        app.logger.info("Batch order failed: %s" % e)
+        return {"error": "Orders could not be placed"}, 400
+    return {"results": [[str(message) for message in res] for res in results]}
+
+
+@app.route("/quotes", methods=["POST"])
+def quotes():
+    """
+    Replace your two-sided quotes on many contract types in one transaction.
+    The request body is JSON: {"quotes": [{"issue": 3, "maturity": 76,
+    "bid": 0.4, "ask": 0.6, "size": 10}, ...]} with prices in tokens.  The
+    response has the resulting messages for each quote.
+    """
+    user = get_user()
+    try:
+        quotes = []
+        for item in request.get_json()["quotes"]:
+            quote = {
+                "issue": int(item["issue"]),
+                "maturity": int(item["maturity"]),
+                "size": int(item.get("size") or 0),
+            }
+            for name in ("bid", "ask"):
+                if item.get(name) is not None:
+                    quote[name] = int(round(float(item[name]) * 1000))
+            quotes.append(quote)
+    except Exception as e:
+        app.logger.info("Bad quote request: %s" % e)
+        return {"error": "Bad or missing quotes"}, 400
+    try:
+        results = market.quotes(user, quotes)
+    except Exception as e:
+        app.logger.info("Quotes failed: %s" % e)
+        return {"error": "Quotes could not be placed"}, 400
+    return {"results": [[str(message) for message in res] for res in results]}
+
+
 @app.route("/cancel", methods=["POST"])
 def cancel():
     user = get_user()
@@ -448,6 +605,62 @@ def cancel():
     )  # FIXME -- should use issue ID from offer's contract type
 
 
+@app.route("/cancel_all", methods=["POST"])
+def cancel_all():
+    """
+    Cancel all of your offers, or just those on one issue, maturity or side.
+    The request body is JSON, for example {"issue": 3, "side": "FIXED"}, with
+    every field optional.  The response has the resulting messages.
+    """
+    user = get_user()
+    try:
+        item = request.get_json() or {}
+        (issue, maturity, side) = (None, None, None)
+        if item.get("issue") is not None:
+            issue = market.issue_by_id(int(item["issue"]))
+            if issue is None:
+                raise ValueError("no such issue")
+        if item.get("maturity") is not None:
+            mid = int(item["maturity"])
+            (maturity,) = [m for m in market.maturities() if m.id == mid]
+        if item.get("side") is not None:
+            if item["side"] not in ("FIXED", "UNFIXED"):
+                raise ValueError("side must be FIXED or UNFIXED")
+            side = item["side"] == "FIXED"
+    except Exception as e:
+        app.logger.info("Bad cancel request: %s" % e)
+        return {"error": "Bad issue, maturity or side"}, 400
+    messages = market.cancel_offers(user, issue=issue, maturity=maturity, side=side)
+    return {"results": [str(message) for message in messages]}
+
+
+@app.route("/amend", methods=["POST"])
+def amend():
+    """
+    Change the price and/or quantity of one of your offers.  The request body
+    is JSON, for example {"offer": 12, "price": 0.3, "quantity": 5}, with the
+    price in tokens.  The response has the resulting messages.
+    """
+    user = get_user()
+    try:
+        item = request.get_json()
+        oid = int(item["offer"])
+        (price, quantity) = (None, None)
+        if item.get("price") is not None:
+            price = int(round(float(item["price"]) * 1000))
+        if item.get("quantity") is not None:
+            quantity = int(item["quantity"])
+    except Exception as e:
+        app.logger.info("Bad amend request: %s" % e)
+        return {"error": "Bad or missing offer, price or quantity"}, 400
+    try:
+        messages = market.amend_offer(user, oid, price, quantity)
+    except Exception as e:
+        app.logger.info("Amend failed: %s" % e)
+        return {"error": "Offer could not be changed"}, 400
+    return {"results": [str(message) for message in messages]}
+
+
 @app.route("/match", methods=["POST"])
 def match():
     "Generate an offer to match an existing offer."
@@ -499,6 +712,19 @@ def offset():
     return redirect(destination)
 
 
+@app.route("/risk", methods=["GET"])
+def risk():
+    "Every account's positions marked to market, biggest first."
+    user = get_user()
+    if not (user.banker or user.oracle):
+        flash("permission denied")
+        return redirect(url_for("index"))
+    accounts = sorted(
+        market.valuation().items(), key=lambda item: item[1]["value"], reverse=True
+    )
+    return render_template("risk.html", user=user, accounts=accounts)
+
+
 @app.route("/resolve", methods=["GET"])
 def resolve():
     user = get_user()
@@ -540,19 +766,44 @@ def post_resolve():
     return redirect(url_for("resolve"))
 
 
+@app.route("/resolve_all", methods=["POST"])
+def post_resolve_all():
+    """
+    Resolve every contract type that needs it at once: FIXED if the issue
+    has been closed, UNFIXED if it is still open.
+    """
+    user = get_user()
+    if not user.oracle:
+        flash("permission denied")
+        return redirect(url_for("index"))
+    (messages, failures) = market.resolve_all()
+    for (contract_type, error) in failures:
+        flash("Failed to resolve %s: %s" % (contract_type, error))
+    flash(
+        "Resolved %d contract types"
+        % len(
+            set(m.contract_type.id for m in messages if m.mclass == "contract_resolved")
+        )
+    )
+    return redirect(url_for("resolve"))
+
+
 @app.route("/history", methods=["GET"])
 def history():
     user = get_user()
-    messages = market.history.filter(ticker=True)
-    return render_template("history.html", user=user, messages=messages)
+    (messages, more) = page_of_messages(ticker=True)
+    return render_template("history.html", user=user, messages=messages, more=more)
 
 
 @app.route("/feed", methods=["GET"])
 def feed():
     messages = []
     (prev_contract, prev_price) = (None, 0)
-    history = market.history.filter()
-    for mess in history:
+    history = market.history.filter(limit=market.history.page_size)
+    while history and len(messages) < 15:
+        mess = history.pop(0)
+        if not history:  # read the next page, as far as needed
+            history = market.history.filter(before=mess, limit=market.history.page_size)
         if not mess.contract_type:
             continue
         # Don't repeat the same contract/price
@@ -565,8 +816,6 @@ def feed():
             or (mess.mclass == "contract_resolved" and mess.price)
         ):
             messages.append(mess)
-        if len(messages) >= 15:
-            break
     res = make_response(render_template("feed.xml", messages=messages))
     res.headers["Content-type"] = "application/xml; charset=utf-8"
     return res